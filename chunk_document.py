@@ -1,12 +1,19 @@
 """Module for chunking documents into token-sized pieces.
 
 This module provides functionality to split long documents into
-chunks based on token count, using Anthropic's tokenizer.
+chunks based on token count, using a local BPE tokenizer.
 """
 
+import os
 import re
 import time
-from typing import List
+import bisect
+import asyncio
+import hashlib
+import logging
+import itertools
+from collections import OrderedDict
+from typing import Iterator, List, Tuple
 
 try:
     import anthropic
@@ -16,34 +23,96 @@ except ImportError:
         "Please install it with: pip install anthropic"
     )
 
+try:
+    import tiktoken
+except ImportError:
+    raise ImportError(
+        "The tiktoken package is required for token counting. "
+        "Please install it with: pip install tiktoken"
+    )
+
+logger = logging.getLogger(__name__)
+
 # Constants
 DEFAULT_MODEL = "claude-3-7-sonnet-20250219"
 TOKEN_COUNT_RATE_LIMIT = 10  # Max requests per minute for token counting API
+TOKEN_COUNT_CACHE_SIZE = 8192  # Number of token counts to remember
+PARALLEL_ENCODE_MIN_BATCH = 256  # Smaller batches aren't worth a thread pool
+DEBUG_CHUNKS = False  # Assert that every chunk fits within tokens_per_chunk
+
+# Anthropic does not publish Claude's tokenizer, so we count with cl100k_base,
+# which runs in-process and tracks Claude's token counts closely. It is
+# loaded on first use (see _get_encoding)
+_encoding = None
+
+# LRU of token counts keyed by a digest of the text, so repeated text is only
+# tokenized once without the cache keeping every text alive
+_token_count_cache = OrderedDict()
+
+# Paragraph and sentence boundaries, compiled once at import
+_PARA_RE = re.compile(r'\n\s*\n')
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Token IDs of the separators placed between paragraphs, sentences and words,
+# filled in when the encoding is loaded
+_PARAGRAPH_SEP_IDS = None
+_SPACE_SEP_IDS = None
+
+
+def _get_encoding() -> "tiktoken.Encoding":
+    """Return the cl100k_base encoding, loading it on first use.
+    
+    tiktoken downloads the encoding the first time it is used, so loading
+    it lazily keeps importing this module (and --help) working offline.
+    
+    Returns:
+        The encoding.
+    """
+    global _encoding, _PARAGRAPH_SEP_IDS, _SPACE_SEP_IDS
+    if _encoding is None:
+        try:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            raise RuntimeError(
+                "Could not load the cl100k_base tokenizer, which tiktoken downloads on first use. "
+                "Check your network connection, or set TIKTOKEN_CACHE_DIR to a directory that already contains it."
+            ) from e
+        _PARAGRAPH_SEP_IDS = encoding.encode_ordinary("\n\n")
+        _SPACE_SEP_IDS = encoding.encode_ordinary(" ")
+        _encoding = encoding
+    return _encoding
 
 
 def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
-    """Count the number of tokens in a text using Anthropic's tokenizer.
+    """Count the number of tokens in a text using a local BPE tokenizer.
+    
+    Counts are cached, so repeated text such as boilerplate headers is
+    only tokenized once.
     
     Args:
         text: The text to count tokens for.
-        model: The model to use for token counting.
+        model: The model the text is destined for (kept for API compatibility).
         
     Returns:
         The number of tokens in the text.
     """
-    print("Counting Tokens!")
-    client = anthropic.Anthropic()
-    response = client.messages.count_tokens(
-        model=model,
-        messages=[{"role": "user", "content": text}]
-    )
-    return response.input_tokens
+    key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    count = _token_count_cache.get(key)
+    if count is None:
+        count = len(_get_encoding().encode(text, disallowed_special=()))
+        _token_count_cache[key] = count
+        if len(_token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            _token_count_cache.popitem(last=False)
+    else:
+        _token_count_cache.move_to_end(key)
+    return count
 
 
 def estimate_tokens(text: str) -> int:
-    """Provide a rough estimate of tokens to reduce API calls.
+    """Provide a rough estimate of tokens without running the tokenizer.
     
-    This is a simple heuristic to reduce API calls for token counting.
+    Uses the common ~4 characters per token rule of thumb, which only
+    needs the string length and so never allocates.
     
     Args:
         text: The text to estimate tokens for.
@@ -51,22 +120,17 @@ def estimate_tokens(text: str) -> int:
     Returns:
         Rough estimate of token count.
     """
-    # Rough heuristic: ~1.5 tokens per word
-    words = len(text.split())
-    return int(words * 1.5)
+    return (len(text) + 3) >> 2
 
 
 class TokenCounter:
-    """Helper class to manage token counting with rate limiting."""
+    """Helper class to count tokens with the local tokenizer."""
     
-    def __init__(self, model: str = DEFAULT_MODEL, max_requests_per_minute: int = TOKEN_COUNT_RATE_LIMIT):
-        self.client = anthropic.Anthropic()
+    def __init__(self, model: str = DEFAULT_MODEL):
         self.model = model
-        self.min_interval = 60.0 / max_requests_per_minute
-        self.last_request_time = 0
         
     def count_tokens(self, text: str) -> int:
-        """Count tokens in text with rate limiting.
+        """Count tokens in text.
         
         Args:
             text: The text to count tokens in.
@@ -74,165 +138,336 @@ class TokenCounter:
         Returns:
             The number of tokens in the text.
         """
-        # Only make API call if absolutely necessary (for larger chunks)
-        # For very short text, use estimate to avoid API calls
-        #if len(text) < 50:
-        #    return estimate_tokens(text)
-        return estimate_tokens(text)
-        
-        # Enforce rate limiting
-        current_time = time.time()
-        elapsed = current_time - self.last_request_time
-        
-        if elapsed < self.min_interval:
-            sleep_time = self.min_interval - elapsed
-            time.sleep(sleep_time)
-        
-        # Make the API call
-        print("Counting Tokens!!!")
-        response = self.client.messages.count_tokens(
+        return count_tokens(text, self.model)
+    
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        """Encode several texts to token IDs.
+        
+        Large batches are spread over one thread per CPU (tiktoken releases
+        the GIL while encoding); small ones are encoded inline, since
+        starting a thread pool costs more than the encoding itself.
+        
+        Args:
+            texts: The texts to encode.
+            
+        Returns:
+            A list of token ID lists, one per input text.
+        """
+        encoding = _get_encoding()
+        num_threads = os.cpu_count() or 1
+        if num_threads > 1 and len(texts) >= PARALLEL_ENCODE_MIN_BATCH:
+            return encoding.encode_ordinary_batch(texts, num_threads=num_threads)
+        return [encoding.encode_ordinary(text) for text in texts]
+
+
+_async_client = None
+
+
+def _get_async_client() -> "anthropic.AsyncAnthropic":
+    """Return a shared AsyncAnthropic client, creating it on first use.
+    
+    Sharing one client means every RemoteTokenCounter reuses the same
+    connection pool instead of paying for a new one (and its TLS
+    handshakes) per instance.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = anthropic.AsyncAnthropic()
+    return _async_client
+
+
+class RemoteTokenCounter:
+    """Count tokens exactly with Anthropic's token counting API.
+    
+    Every count is a network round-trip, so this is meant for auditing the
+    local counts rather than for chunking. Requests run concurrently, paced
+    by a token bucket that refills at the API's rate limit.
+    """
+    
+    def __init__(self, model: str = DEFAULT_MODEL, max_requests_per_minute: int = TOKEN_COUNT_RATE_LIMIT):
+        self.client = _get_async_client()
+        self.model = model
+        self.max_requests_per_minute = max_requests_per_minute
+        self.available_requests = float(max_requests_per_minute)
+        self.last_refill_time = time.monotonic()
+    
+    async def _acquire(self):
+        """Wait until the rate limit allows another request."""
+        refill_rate = self.max_requests_per_minute / 60.0
+        while True:
+            now = time.monotonic()
+            self.available_requests = min(
+                self.max_requests_per_minute,
+                self.available_requests + (now - self.last_refill_time) * refill_rate
+            )
+            self.last_refill_time = now
+            
+            if self.available_requests >= 1:
+                self.available_requests -= 1
+                return
+            await asyncio.sleep((1 - self.available_requests) / refill_rate)
+    
+    async def count_tokens(self, text: str) -> int:
+        """Count tokens in text with the API.
+        
+        Args:
+            text: The text to count tokens in.
+            
+        Returns:
+            The number of tokens in the text.
+        """
+        await self._acquire()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Counting tokens remotely for %d characters", len(text))
+        response = await self.client.messages.count_tokens(
             model=self.model,
             messages=[{"role": "user", "content": text}]
         )
-        
-        self.last_request_time = time.time()
         return response.input_tokens
+    
+    async def count_tokens_many(self, texts: List[str]) -> List[int]:
+        """Count tokens in several texts concurrently.
+        
+        Args:
+            texts: The texts to count tokens in.
+            
+        Returns:
+            The number of tokens in each text, in input order.
+        """
+        semaphore = asyncio.Semaphore(self.max_requests_per_minute)
+        
+        async def bounded_count(text):
+            async with semaphore:
+                return await self.count_tokens(text)
+        
+        return await asyncio.gather(*(bounded_count(text) for text in texts))
 
 
-def chunk_document(document: str, tokens_per_chunk: int, model: str = DEFAULT_MODEL) -> List[str]:
-    """Split a document into chunks of specified token size.
+def _sentence_spans(paragraph: str) -> List[Tuple[int, int]]:
+    """Find the (start, end) offsets of the sentences in a paragraph.
+    
+    The spans exclude the whitespace between sentences, matching what
+    splitting on that whitespace would produce.
     
     Args:
-        document: The document text to split into chunks.
-        tokens_per_chunk: Maximum number of tokens per chunk.
-        model: The model to use for token counting.
+        paragraph: The paragraph text.
         
     Returns:
-        A list of document chunks, where each chunk is a string with
-        tokens_per_chunk or fewer tokens.
+        Start and end offsets of each sentence, in order.
     """
-    # Initialize token counter with rate limiting
-    token_counter = TokenCounter(model)
+    spans = []
+    start = 0
+    for match in _SENT_RE.finditer(paragraph):
+        spans.append((start, match.start()))
+        start = match.end()
+    spans.append((start, len(paragraph)))
+    return spans
+
+
+def _split_long_word(ids: List[int], tokens_per_chunk: int) -> Iterator[List[int]]:
+    """Cut a word longer than a whole chunk into pieces of at most tokens_per_chunk.
     
-    # Split document into paragraphs first to preserve some structure
-    paragraphs = re.split(r'\n\s*\n', document)
+    A token can hold part of a multi-byte character, so each cut is moved back
+    to the nearest character boundary; a piece then never decodes to U+FFFD.
+    This matters for scripts like CJK, where a whole paragraph is one "word".
     
+    Args:
+        ids: The word's token IDs.
+        tokens_per_chunk: Maximum number of tokens per chunk.
+        
+    Returns:
+        The word's token IDs, in pieces.
+    """
+    # A cut before token k is clean unless token k starts with a UTF-8
+    # continuation byte (0b10xxxxxx)
+    encoding = _get_encoding()
+    clean_cut = [(encoding.decode_single_token_bytes(token_id)[0] & 0xC0) != 0x80 for token_id in ids]
+    start = 0
+    while len(ids) - start > tokens_per_chunk:
+        end = start + tokens_per_chunk
+        while end > start and not clean_cut[end]:
+            end -= 1
+        if end == start:
+            # One character spans more tokens than a chunk holds, so keep it whole
+            end = start + tokens_per_chunk
+            while end < len(ids) and not clean_cut[end]:
+                end += 1
+        yield ids[start:end]
+        start = end
+    yield ids[start:]
+
+
+def _pack_words(word_ids: List[List[int]], tokens_per_chunk: int) -> List[List[int]]:
+    """Greedily pack space-separated words into chunks of at most tokens_per_chunk.
+    
+    Args:
+        word_ids: The token IDs of each word, in order.
+        tokens_per_chunk: Maximum number of tokens per chunk.
+        
+    Returns:
+        A list of chunks, each a flat list of token IDs.
+    """
     chunks = []
-    current_chunk = []
-    current_chunk_tokens = 0
-    
-    # Batch token counting for efficiency
-    # First pass: use estimates to create initial paragraphs
-    for paragraph in paragraphs:
-        # Skip empty paragraphs
-        if not paragraph.strip():
+    sep_tokens = len(_SPACE_SEP_IDS)
+    i = 0
+    while i < len(word_ids):
+        ids = word_ids[i]
+        
+        # A single word longer than a whole chunk has to be cut at token boundaries
+        if len(ids) > tokens_per_chunk:
+            chunks.extend(_split_long_word(ids, tokens_per_chunk))
+            i += 1
             continue
-            
-        # Estimate tokens for this paragraph to reduce API calls
-        estimated_tokens = estimate_tokens(paragraph)
         
-        # For large paragraphs, use accurate counting
-        if estimated_tokens > tokens_per_chunk * 0.8:
-            paragraph_tokens = token_counter.count_tokens(paragraph)
-        else:
-            paragraph_tokens = estimated_tokens
+        # Advance j past every following word that still fits alongside word i
+        chunk_tokens = len(ids)
+        j = i + 1
+        while j < len(word_ids) and chunk_tokens + sep_tokens + len(word_ids[j]) <= tokens_per_chunk:
+            chunk_tokens += sep_tokens + len(word_ids[j])
+            j += 1
         
-        # If a single paragraph is larger than tokens_per_chunk, we need to split it
-        if paragraph_tokens > tokens_per_chunk:
-            # If we have content in the current chunk, finalize it
-            if current_chunk:
-                chunks.append('\n\n'.join(current_chunk))
-                current_chunk = []
-                current_chunk_tokens = 0
-            
-            # Split the paragraph into sentences
-            sentences = re.split(r'(?<=[.!?])\s+', paragraph)
-            sentence_buffer = []
-            buffer_tokens = 0
-            
-            for sentence in sentences:
-                # Use estimate for short sentences
-                if len(sentence) < 200:
-                    sentence_tokens = estimate_tokens(sentence)
-                else:
-                    sentence_tokens = token_counter.count_tokens(sentence)
-                
-                # If this single sentence is too large, we must split it further
-                if sentence_tokens > tokens_per_chunk:
-                    # Handle excessively long sentences by breaking them into pieces
-                    words = sentence.split()
-                    word_buffer = []
-                    word_buffer_tokens = 0
-                    
-                    for word in words:
-                        # Use estimate for words (they're always short)
-                        word_tokens = estimate_tokens(word + ' ')
-                        
-                        if word_buffer_tokens + word_tokens <= tokens_per_chunk:
-                            word_buffer.append(word)
-                            word_buffer_tokens += word_tokens
-                        else:
-                            # Finalize current word buffer as a chunk
-                            if word_buffer:
-                                chunks.append(' '.join(word_buffer))
-                                word_buffer = [word]
-                                word_buffer_tokens = word_tokens
-                    
-                    # Add any remaining words
-                    if word_buffer:
-                        chunks.append(' '.join(word_buffer))
-                
-                # If adding this sentence would exceed our chunk size, finalize the buffer
-                elif buffer_tokens + sentence_tokens > tokens_per_chunk:
-                    if sentence_buffer:
-                        chunks.append(' '.join(sentence_buffer))
-                        sentence_buffer = [sentence]
-                        buffer_tokens = sentence_tokens
-                    else:
-                        # Edge case: first sentence in buffer is already too big
-                        chunks.append(sentence)
-                
-                # Otherwise add the sentence to our buffer
-                else:
-                    sentence_buffer.append(sentence)
-                    buffer_tokens += sentence_tokens
-            
-            # Add any remaining sentences in the buffer
-            if sentence_buffer:
-                chunks.append(' '.join(sentence_buffer))
+        chunk = list(ids)
+        for ids in word_ids[i + 1:j]:
+            chunk += _SPACE_SEP_IDS
+            chunk += ids
+        chunks.append(chunk)
+        i = j
+    
+    return chunks
+
+
+def _decode_chunk(chunk: List[int], tokens_per_chunk: int) -> str:
+    """Decode a finished chunk's token IDs back to text.
+    
+    Args:
+        chunk: The chunk's token IDs.
+        tokens_per_chunk: Maximum number of tokens per chunk.
+        
+    Returns:
+        The chunk text.
+    """
+    # Token counts are exact by construction, so no verification is needed
+    if DEBUG_CHUNKS:
+        assert len(chunk) <= tokens_per_chunk, f"Chunk has {len(chunk)} tokens"
+    return _get_encoding().decode(chunk)
+
+
+def _split_paragraph(paragraph: str, token_counter: TokenCounter, tokens_per_chunk: int) -> Iterator[List[int]]:
+    """Split a paragraph that is too large for one chunk at sentence boundaries.
+    
+    Args:
+        paragraph: The paragraph text.
+        token_counter: The token counter used to encode sentences and words.
+        tokens_per_chunk: Maximum number of tokens per chunk.
         
-        # If adding this paragraph would exceed chunk size, finalize current chunk
-        elif current_chunk_tokens + paragraph_tokens > tokens_per_chunk:
-            chunks.append('\n\n'.join(current_chunk))
-            current_chunk = [paragraph]
-            current_chunk_tokens = paragraph_tokens
+    Yields:
+        The token IDs of each chunk, in order.
+    """
+    # Slice out the sentence text only to encode it (and again for the rare
+    # oversized sentence)
+    sentence_spans = _sentence_spans(paragraph)
+    sentence_ids = token_counter.encode_batch([paragraph[start:end] for start, end in sentence_spans])
+    sentence_buffer = []
+    
+    for (start, end), ids in zip(sentence_spans, sentence_ids):
+        sentence_tokens = len(ids)
         
-        # Otherwise add paragraph to current chunk
-        else:
-            current_chunk.append(paragraph)
-            current_chunk_tokens += paragraph_tokens
-    
-    # Add the final chunk if there's anything left
-    if current_chunk:
-        chunks.append('\n\n'.join(current_chunk))
-    
-    # Verify final chunks to make sure they don't exceed the token limit
-    # This is important because our estimates might be off
-    verified_chunks = []
-    for chunk in chunks:
-        # For larger chunks, verify token count
-        if len(chunk) > 1000:
-            chunk_tokens = token_counter.count_tokens(chunk)
+        # If this single sentence is too large, we must split it further
+        if sentence_tokens > tokens_per_chunk:
+            # Flush buffered sentences first so chunks stay in document order
+            if sentence_buffer:
+                yield sentence_buffer
+                sentence_buffer = []
             
-            # If the chunk is too large, we need to split it further
-            # But this should be rare due to our conservative estimates
-            if chunk_tokens > tokens_per_chunk * 1.1:  # Allow 10% buffer
-                # Recursively chunk this oversized chunk
-                sub_chunks = chunk_document(chunk, tokens_per_chunk, model)
-                verified_chunks.extend(sub_chunks)
+            # Handle excessively long sentences by breaking them into pieces
+            word_ids = token_counter.encode_batch(paragraph[start:end].split())
+            yield from _pack_words(word_ids, tokens_per_chunk)
+        
+        # If adding this sentence would exceed our chunk size, finalize the buffer
+        elif len(sentence_buffer) + len(_SPACE_SEP_IDS) + sentence_tokens > tokens_per_chunk:
+            if sentence_buffer:
+                yield sentence_buffer
+                sentence_buffer = list(ids)
             else:
-                verified_chunks.append(chunk)
+                # Edge case: first sentence in buffer is already too big
+                yield ids
+        
+        # Otherwise add the sentence to our buffer
         else:
-            verified_chunks.append(chunk)
+            if sentence_buffer:
+                sentence_buffer += _SPACE_SEP_IDS
+            sentence_buffer += ids
+    
+    # Add any remaining sentences in the buffer
+    if sentence_buffer:
+        yield sentence_buffer
+
+
+def iter_chunks(document: str, tokens_per_chunk: int, model: str = DEFAULT_MODEL) -> Iterator[str]:
+    """Split a document into chunks of specified token size, yielding each as it is finished.
     
-    return verified_chunks
\ No newline at end of file
+    Chunks are assembled from token ID lists and only decoded back to
+    text as each one is finished, so each chunk's token count is known
+    exactly without re-tokenizing it. Every paragraph is encoded up front,
+    so the token IDs for the whole document stay in memory until the last
+    chunk is yielded; this does not lower peak memory over chunk_document.
+    
+    Args:
+        document: The document text to split into chunks.
+        tokens_per_chunk: Maximum number of tokens per chunk.
+        model: The model to use for token counting.
+        
+    Yields:
+        Document chunks in order, each a string with tokens_per_chunk or
+        fewer tokens.
+    """
+    # Initialize token counter
+    token_counter = TokenCounter(model)
+    
+    # Split document into paragraphs first to preserve some structure
+    # (blank ones are dropped with isspace(), which doesn't allocate a copy)
+    paragraphs = [p for p in _PARA_RE.split(document) if p and not p.isspace()]
+    
+    # Encode every paragraph in one batched tokenizer call
+    paragraph_ids = token_counter.encode_batch(paragraphs)
+    
+    # Prefix sums of each paragraph's tokens plus one separator, so joining
+    # paragraphs i..j-1 costs offsets[j] - offsets[i] - separator tokens
+    separator_tokens = len(_PARAGRAPH_SEP_IDS)
+    offsets = [0]
+    offsets.extend(itertools.accumulate(len(ids) + separator_tokens for ids in paragraph_ids))
+    
+    i = 0
+    while i < len(paragraphs):
+        # If a single paragraph is larger than tokens_per_chunk, we need to split it
+        if len(paragraph_ids[i]) > tokens_per_chunk:
+            for chunk in _split_paragraph(paragraphs[i], token_counter, tokens_per_chunk):
+                yield _decode_chunk(chunk, tokens_per_chunk)
+            i += 1
+            continue
+        
+        # Binary search for the most paragraphs that fit in this chunk
+        j = bisect.bisect_right(offsets, offsets[i] + tokens_per_chunk + separator_tokens, i + 1) - 1
+        
+        chunk = list(paragraph_ids[i])
+        for ids in paragraph_ids[i + 1:j]:
+            chunk += _PARAGRAPH_SEP_IDS
+            chunk += ids
+        yield _decode_chunk(chunk, tokens_per_chunk)
+        i = j
+
+
+def chunk_document(document: str, tokens_per_chunk: int, model: str = DEFAULT_MODEL) -> List[str]:
+    """Split a document into chunks of specified token size.
+    
+    Args:
+        document: The document text to split into chunks.
+        tokens_per_chunk: Maximum number of tokens per chunk.
+        model: The model to use for token counting.
+        
+    Returns:
+        A list of document chunks, where each chunk is a string with
+        tokens_per_chunk or fewer tokens.
+    """
+    return list(iter_chunks(document, tokens_per_chunk, model))
+
@@ -0,0 +1,18 @@
+"""Inputs shared by the summary pyramid and summary rollup tools."""
+
+import os
+
+
+def read_query(query: str) -> str:
+    """Read the user's query from a file, or take it as given.
+    
+    Args:
+        query: Path to a file containing the query, or the query itself.
+        
+    Returns:
+        The query text with surrounding whitespace removed.
+    """
+    if os.path.isfile(query):
+        with open(query, "r", encoding="utf-8") as f:
+            query = f.read()
+    return query.strip()
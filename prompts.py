@@ -5,11 +5,36 @@ prompts that can be sent to the AI model.
 """
 
 import os
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 # Set up Jinja environment
 template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_templates")
-env = Environment(loader=FileSystemLoader(template_dir))
+# Templates never change while the tool runs, so skip the per-render stat()
+# checks and keep compiled bytecode around between runs
+env = Environment(
+    loader=FileSystemLoader(template_dir),
+    auto_reload=False,
+    cache_size=-1,
+    bytecode_cache=FileSystemBytecodeCache(),
+)
+
+# Load every template once at import time. Each template wraps its body in a
+# `render` macro, which we call with positional arguments to skip building a
+# render Context for every prompt
+_TEMPLATES = {name: env.get_template(name) for name in (
+    "explanation.jinja",
+    "base_summary.jinja",
+    "recursive_summary.jinja",
+    "final_answer.jinja",
+    "packed_summaries.jinja",
+)}
+
+# Bound once so each prompt is a single macro call with no lookups
+_render_explanation = _TEMPLATES["explanation.jinja"].module.render
+_render_base_summary = _TEMPLATES["base_summary.jinja"].module.render
+_render_recursive_summary = _TEMPLATES["recursive_summary.jinja"].module.render
+_render_final_answer = _TEMPLATES["final_answer.jinja"].module.render
+_render_packed_summaries = _TEMPLATES["packed_summaries.jinja"].module.render
 
 
 def get_system_prompt(context_window_size, tokens_per_selection=10_000, summary_token_limit=1_000):
@@ -23,11 +48,10 @@ def get_system_prompt(context_window_size, tokens_per_selection=10_000, summary_
     Returns:
         str: The rendered system prompt.
     """
-    template = env.get_template("explanation.jinja")
-    return template.render(
-        context_window_size=context_window_size,
-        tokens_per_selection=tokens_per_selection,
-        summary_token_limit=summary_token_limit
+    return _render_explanation(
+        context_window_size,
+        tokens_per_selection,
+        summary_token_limit
     )
 
 
@@ -44,13 +68,12 @@ def get_base_summary_prompt(user_query, total_chunks, chunk_range_start, chunk_r
     Returns:
         str: The rendered base summary prompt.
     """
-    template = env.get_template("base_summary.jinja")
-    return template.render(
-        user_query=user_query,
-        total_chunks=total_chunks,
-        chunk_range_start=chunk_range_start,
-        chunk_range_end=chunk_range_end,
-        chunk_content=chunk_content
+    return _render_base_summary(
+        user_query,
+        total_chunks,
+        chunk_range_start,
+        chunk_range_end,
+        chunk_content
     )
 
 
@@ -76,17 +99,23 @@ def get_recursive_summary_prompt(user_query, total_chunks, summary_level, summar
     Returns:
         str: The rendered recursive summary prompt.
     """
-    template = env.get_template("recursive_summary.jinja")
-    return template.render(
-        user_query=user_query,
-        total_chunks=total_chunks,
-        summary_level=summary_level,
-        summary_range_start=summary_range_start,
-        summary_range_end=summary_range_end,
-        total_summaries=total_summaries,
-        chunk_range_start=chunk_range_start,
-        chunk_range_end=chunk_range_end,
-        summaries=summaries
+    # Build the summary list here rather than looping in the template, which
+    # would resolve each field through Jinja's attribute lookup
+    summaries_block = "".join(
+        f"\nSummary of chunks {summary['start_chunk']} through {summary['end_chunk']}:\n"
+        f"<SUMMARY>\n{summary['content']}\n</SUMMARY>\n\n"
+        for summary in summaries
+    )
+    return _render_recursive_summary(
+        user_query,
+        total_chunks,
+        summary_level,
+        summary_range_start,
+        summary_range_end,
+        total_summaries,
+        chunk_range_start,
+        chunk_range_end,
+        summaries_block
     )
 
 
@@ -102,10 +131,26 @@ def get_final_answer_prompt(user_query, total_chunks, total_summary_levels, fina
     Returns:
         str: The rendered final answer prompt.
     """
-    template = env.get_template("final_answer.jinja")
-    return template.render(
-        user_query=user_query,
-        total_chunks=total_chunks,
-        total_summary_levels=total_summary_levels,
-        final_summary=final_summary
-    )
\ No newline at end of file
+    return _render_final_answer(
+        user_query,
+        total_chunks,
+        total_summary_levels,
+        final_summary
+    )
+
+
+def get_packed_summary_prompt(window_prompts):
+    """Render a prompt that asks for several independent summaries in one reply.
+    
+    Args:
+        window_prompts (list): The rendered base or recursive summary prompt
+            for each window, in order. Window ids are numbered from 1.
+        
+    Returns:
+        str: The rendered packed summary prompt.
+    """
+    windows_block = "\n\n".join(
+        f'<WINDOW id="{window_id}">\n{window_prompt}\n</WINDOW>'
+        for window_id, window_prompt in enumerate(window_prompts, start=1)
+    )
+    return _render_packed_summaries(len(window_prompts), windows_block)
@@ -0,0 +1,156 @@
+"""Client-side rate limiting and retries for Anthropic API requests.
+
+Pacing requests ourselves keeps large concurrent runs under the account's
+requests-per-minute and tokens-per-minute limits, instead of finding the
+limits through 429 responses and retries.
+"""
+
+import time
+import random
+import asyncio
+import functools
+from typing import Mapping, Optional
+import anthropic
+
+DEFAULT_MAX_ATTEMPTS = 8  # Attempts per request before giving up
+RETRY_MIN_DELAY = 1       # Seconds; the backoff window starts here
+RETRY_MAX_DELAY = 60      # Seconds; the backoff window never grows past this
+
+
+class AsyncRateLimiter:
+    """Token bucket that limits both requests and tokens per minute.
+
+    Each bucket starts full and refills continuously at its per-minute
+    rate. A limit of None disables that bucket.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = float(rpm or 0)
+        self.available_tokens = float(tpm or 0)
+        self.last_refill_time = time.monotonic()
+
+    def _refill(self):
+        """Top up both buckets for the time elapsed since the last refill."""
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill_time) / 60.0
+        self.last_refill_time = now
+        if self.rpm:
+            self.available_requests = min(self.rpm, self.available_requests + elapsed_minutes * self.rpm)
+        if self.tpm:
+            self.available_tokens = min(self.tpm, self.available_tokens + elapsed_minutes * self.tpm)
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until the limits allow a request using the given number of tokens.
+
+        Args:
+            tokens: Estimated input plus output tokens for the request.
+        """
+        if self.tpm:
+            # A request bigger than the whole bucket could never be admitted
+            tokens = min(tokens, self.tpm)
+
+        while True:
+            self._refill()
+            wait = 0.0
+            if self.rpm and self.available_requests < 1:
+                wait = max(wait, (1 - self.available_requests) * 60.0 / self.rpm)
+            if self.tpm and self.available_tokens < tokens:
+                wait = max(wait, (tokens - self.available_tokens) * 60.0 / self.tpm)
+
+            if wait <= 0:
+                if self.rpm:
+                    self.available_requests -= 1
+                if self.tpm:
+                    self.available_tokens -= tokens
+                return
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Lower the buckets to the remaining capacity the API reports.
+
+        Other clients sharing the API key draw on the same limits, so the
+        server can have less capacity left than the buckets assume. The
+        buckets are only ever lowered; they refill at the configured rate.
+
+        Args:
+            headers: Response headers, including anthropic-ratelimit-*.
+        """
+        self._refill()
+        if self.rpm:
+            remaining = _parse_header(headers, "anthropic-ratelimit-requests-remaining")
+            if remaining is not None:
+                self.available_requests = min(self.available_requests, remaining)
+        if self.tpm:
+            remaining = _parse_header(headers, "anthropic-ratelimit-tokens-remaining")
+            if remaining is not None:
+                self.available_tokens = min(self.available_tokens, remaining)
+
+
+def _parse_header(headers: Mapping[str, str], name: str) -> Optional[float]:
+    """Return a numeric header value, or None if it's missing or malformed."""
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Check whether an API error is transient and worth retrying.
+
+    Covers network failures and timeouts, plus the statuses the SDK itself
+    retries: 408, 409, 429 and any 5xx (including 529 overloaded).
+    """
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Return how long to wait before retrying after a failed attempt.
+
+    Uses the server's retry-after header when present, and otherwise
+    exponential backoff with full jitter so concurrent requests that failed
+    together don't all retry at the same moment.
+
+    Args:
+        error: The error from the failed attempt.
+        attempt: Number of attempts made so far, starting at 1.
+
+    Returns:
+        The delay in seconds.
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass  # An HTTP date rather than seconds; fall back to backoff
+    return random.uniform(RETRY_MIN_DELAY, min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** attempt))
+
+
+def retry_on_transient_errors(max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+    """Decorate an async function to retry when the API call fails transiently.
+
+    Args:
+        max_attempts: Total attempts before the last error is raised.
+
+    Returns:
+        The decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    return await func(*args, **kwargs)
+                except anthropic.APIError as e:
+                    if attempt == max_attempts or not is_retryable(e):
+                        raise
+                    await asyncio.sleep(retry_delay(e, attempt))
+        return wrapper
+    return decorator
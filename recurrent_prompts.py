@@ -5,11 +5,32 @@ which processes documents sequentially section by section.
 """
 
 import os
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 # Set up Jinja environment
 template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recurrent_prompt_templates")
-env = Environment(loader=FileSystemLoader(template_dir))
+# Templates never change while the tool runs, so skip the per-render stat()
+# checks and keep compiled bytecode around between runs
+env = Environment(
+    loader=FileSystemLoader(template_dir),
+    auto_reload=False,
+    cache_size=-1,
+    bytecode_cache=FileSystemBytecodeCache(),
+)
+
+# Load every template once at import time. Each template wraps its body in a
+# `render` macro, which we call with positional arguments to skip building a
+# render Context for every prompt
+_TEMPLATES = {name: env.get_template(name) for name in (
+    "system_prompt.jinja",
+    "base_summary.jinja",
+    "recursive_summary.jinja",
+)}
+
+# Bound once so each prompt is a single macro call with no lookups
+_render_system_prompt = _TEMPLATES["system_prompt.jinja"].module.render
+_render_base_summary = _TEMPLATES["base_summary.jinja"].module.render
+_render_recursive_summary = _TEMPLATES["recursive_summary.jinja"].module.render
 
 
 def get_system_prompt(context_window_size, tokens_per_selection=5000, summary_token_limit=2000):
@@ -23,11 +44,10 @@ def get_system_prompt(context_window_size, tokens_per_selection=5000, summary_to
     Returns:
         str: The rendered system prompt.
     """
-    template = env.get_template("system_prompt.jinja")
-    return template.render(
-        context_window_size=context_window_size,
-        tokens_per_selection=tokens_per_selection,
-        summary_token_limit=summary_token_limit
+    return _render_system_prompt(
+        context_window_size,
+        tokens_per_selection,
+        summary_token_limit
     )
 
 
@@ -43,12 +63,11 @@ def get_base_summary_prompt(user_query, total_chunks, chunk_content, summary_tok
     Returns:
         str: The rendered prompt for the initial summary.
     """
-    template = env.get_template("base_summary.jinja")
-    return template.render(
-        user_query=user_query,
-        total_chunks=total_chunks,
-        chunk_content=chunk_content,
-        summary_token_limit=summary_token_limit
+    return _render_base_summary(
+        user_query,
+        total_chunks,
+        chunk_content,
+        summary_token_limit
     )
 
 
@@ -69,13 +88,12 @@ def get_recursive_summary_prompt(user_query, total_chunks, current_chunk,
     Returns:
         str: The rendered prompt for updating the summary.
     """
-    template = env.get_template("recursive_summary.jinja")
-    return template.render(
-        user_query=user_query,
-        total_chunks=total_chunks,
-        current_chunk=current_chunk,
-        chunks_processed=chunks_processed,
-        current_summary=current_summary,
-        new_chunk_content=new_chunk_content,
-        summary_token_limit=summary_token_limit
+    return _render_recursive_summary(
+        user_query,
+        total_chunks,
+        current_chunk,
+        chunks_processed,
+        current_summary,
+        new_chunk_content,
+        summary_token_limit
     )
\ No newline at end of file
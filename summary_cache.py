@@ -0,0 +1,58 @@
+"""On-disk cache of summaries, so re-runs skip requests they have already made.
+
+Each response is stored under a SHA-256 of the complete request. The key
+covers the model, system prompt, rendered user prompt and token limit, so
+changing the document, query, prompt templates or any setting that affects
+a request is simply a cache miss.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from typing import Dict, Optional
+
+DEFAULT_CACHE_DIR = "summary_cache"
+
+
+class SummaryCache:
+    """Disk-backed map from messages.create parameters to response text."""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, request: Dict) -> str:
+        """Return the cache file path for a request."""
+        key = hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, request: Dict) -> Optional[str]:
+        """Look up the cached response text for a request.
+
+        Args:
+            request: Keyword arguments for messages.create.
+
+        Returns:
+            The cached response text, or None if the request isn't cached.
+        """
+        try:
+            with open(self._path(request), "r", encoding="utf-8") as f:
+                return json.load(f)["text"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def put(self, request: Dict, text: str):
+        """Store the response text for a request.
+
+        The entry is written to a temporary file and renamed into place, so
+        an interrupted run never leaves a partial entry behind.
+
+        Args:
+            request: Keyword arguments for messages.create.
+            text: The response text.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"model": request["model"], "text": text}, f)
+        os.replace(tmp_path, self._path(request))
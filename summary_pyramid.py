@@ -1,233 +1,1147 @@
 import os
+import re
+import sys
 import time
 import shutil
+import asyncio
 import argparse
-from typing import List, Tuple, Dict
+from typing import Dict, List, Optional, Tuple
 import anthropic
 import prompts
-from chunk_document import chunk_document
+from chunk_document import chunk_document, count_tokens, estimate_tokens
+from config import read_query
+from rate_limiter import AsyncRateLimiter, retry_on_transient_errors
+from summary_cache import DEFAULT_CACHE_DIR, SummaryCache
+
+# A summary is (summary content, start_chunk_index, end_chunk_index)
+Summary = Tuple[str, int, int]
+
+DEFAULT_MAX_CONCURRENCY = 8  # Max summary requests in flight at once
+BATCH_POLL_INITIAL_DELAY = 1  # Seconds before the first batch status check
+BATCH_POLL_MAX_DELAY = 30     # Cap on seconds between batch status checks
+BATCH_MIN_REQUESTS = 2        # Fewer requests than this skip the batch queue and are sent directly
+# Most output tokens each model family can return, keyed by model name prefix,
+# so a packed reply is never asked for more than its model allows
+MAX_OUTPUT_TOKENS = {
+    "claude-3-haiku": 4096,
+    "claude-3-sonnet": 4096,
+    "claude-3-opus": 4096,
+    "claude-3-5-haiku": 8192,
+    "claude-3-5-sonnet": 8192,
+    "claude-3-7-sonnet": 64000,
+}
+DEFAULT_MAX_OUTPUT_TOKENS = 4096  # Assumed for models not listed above; every Claude model allows this
+_WINDOW_SUMMARY_RE = re.compile(r'<WINDOW_SUMMARY id="(\d+)">(.*?)</WINDOW_SUMMARY>', re.DOTALL)
+ANSWER_PROMPT_MARGIN = 1000  # Tokens reserved for the final answer template and query
+SUMMARY_TEMPERATURE = 0.0  # Summaries should be faithful and repeatable, not creative
+
+_client = None
+_client_uses_http2 = False
+
+
+def get_client(http2: Optional[bool] = None) -> anthropic.AsyncAnthropic:
+    """Return the shared AsyncAnthropic client, creating it on first use.
+
+    Args:
+        http2: Whether to multiplex requests over HTTP/2. If this differs
+            from the existing client's setting, a new client replaces it.
+            None keeps whichever client exists (HTTP/1.1 if there is none).
+
+    Returns:
+        The shared client.
+    """
+    global _client, _client_uses_http2
+    if _client is None or (http2 is not None and http2 != _client_uses_http2):
+        http2 = bool(http2)
+        if http2:
+            check_http2_support()
+        # Retries are handled by retry_on_transient_errors, so turn off the
+        # SDK's own retries rather than multiplying the two. The SDK's default
+        # HTTP client keeps its connection limits and timeouts; we only opt in
+        # to HTTP/2 on top of them
+        http_client = anthropic.DefaultAsyncHttpxClient(http2=True) if http2 else None
+        _client = anthropic.AsyncAnthropic(max_retries=0, http_client=http_client)
+        _client_uses_http2 = http2
+    return _client
+
+
+def check_http2_support():
+    """Make sure httpx can speak HTTP/2, which is only needed for --http2."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "The h2 package is required for --http2. "
+            "Please install it with: pip install httpx[http2]"
+        )
+
+
+def get_uvloop():
+    """Import uvloop, which is only needed for --uvloop."""
+    try:
+        import uvloop
+    except ImportError:
+        raise ImportError(
+            "The uvloop package is required for --uvloop. "
+            "Please install it with: pip install uvloop"
+        )
+    return uvloop
+
+
+def get_progress_bar():
+    """Import tqdm's asyncio progress bar, which is only needed for --progress."""
+    try:
+        from tqdm.asyncio import tqdm_asyncio
+    except ImportError:
+        raise ImportError(
+            "The tqdm package is required for --progress. "
+            "Please install it with: pip install tqdm"
+        )
+    return tqdm_asyncio
+
 
 ###########################################################################
-## SETUP
+## SUMMARY PYRAMID
 ###########################################################################
 
-"""Main function for command line usage of the summary pyramid system."""
-parser = argparse.ArgumentParser(description="Generate a summary pyramid for a document and answer queries")
+def get_windows(num_items: int, window_size: int, stride: int) -> List[Tuple[int, int]]:
+    """Return the (start, end) index pairs of the sliding windows over a level.
 
-# Input document and query
-parser.add_argument("--document", default="documents/mobydick.txt", help="Path to the document file")
-parser.add_argument("--query", default="queries/query.txt", help="Path to query file or direct query string")
+    Stops at the first window that reaches the end of the level: any later
+    window would only cover items that window already includes, and would
+    cost a call to summarize them a second time (often a single summary).
 
-# Model and token parameters
-parser.add_argument("--model", default="claude-3-7-sonnet-20250219", help="Claude model to use")
-parser.add_argument("--context-window", type=int, default=100000, help="Context window size in tokens")
-parser.add_argument("--tokens-per-selection", type=int, default=5000, help="Target size for content selections in tokens")
-parser.add_argument("--tokens-per-chunk", type=int, default=1000, help="Size to chunk the document into")
-parser.add_argument("--summary-token-limit", type=int, default=2000, help="Maximum token limit for summaries")
-parser.add_argument("--answer-token-limit", type=int, default=4000, help="Maximum token limit for final answer")
+    Args:
+        num_items: Number of items in the level being summarized.
+        window_size: Number of items per window.
+        stride: Number of items to advance between windows.
 
-# Sliding window parameters
-parser.add_argument("--window-size", type=int, default=5, help="Window size for all summary levels")
-parser.add_argument("--stride", type=int, default=4, help="Stride for all summary levels")
+    Returns:
+        List of (start_idx, end_idx) pairs, with end_idx exclusive.
+    """
+    windows = []
+    for window_start_idx in range(0, num_items, stride):
+        window_end_idx = min(window_start_idx + window_size, num_items)
+        windows.append((window_start_idx, window_end_idx))
+        if window_end_idx == num_items:
+            break
+    return windows
 
-# Output parameters
-parser.add_argument("--output-dir", default="pyramid_output", help="Directory to store outputs")
-parser.add_argument("--clear-output", action="store_true", help="Clear output directory if it exists")
 
-args = parser.parse_args()
+def get_base_window(window_size: int, stride: int, base_window_size: Optional[int] = None,
+                    base_stride: Optional[int] = None) -> Tuple[int, int]:
+    """Resolve the window size and stride for the base level.
 
-# Ensure stride is reasonable (to ensure we make progress)
-assert args.stride > 0, "Stride must be at least 1"
+    Args:
+        window_size: Window size for the summary levels.
+        stride: Stride for the summary levels.
+        base_window_size: Window size for the base level, if not window_size.
+        base_stride: Stride for the base level, if not stride (capped at
+            the base window size).
 
-# Set up output directory
-if args.clear_output and os.path.exists(args.output_dir):
-    shutil.rmtree(args.output_dir)
-os.makedirs(args.output_dir, exist_ok=True)
+    Returns:
+        The base level's (window_size, stride).
+    """
+    if base_window_size is None:
+        base_window_size = window_size
+    if base_stride is None:
+        # Never stride past the end of a base window, which would skip chunks
+        base_stride = min(stride, base_window_size)
+    return base_window_size, base_stride
 
-# Read the document
-with open(args.document, "r", encoding="utf-8") as f:
-    document = f.read()
 
-# Read the query - either from file or directly from command line
-if os.path.exists(args.query):
-    with open(args.query, "r", encoding="utf-8") as f:
-        query = f.read().strip()
-else:
-    query = args.query.strip()
+def get_max_output_tokens(model: str) -> int:
+    """Return the most output tokens a model can produce in one response.
 
-print(f"Document length: {len(document)} characters")
-print(f"Query: {query}")
+    Args:
+        model: The Claude model name, e.g. claude-3-5-haiku-latest.
 
-# Chunk the document
-start_time = time.time()
-chunks = chunk_document(document, args.tokens_per_chunk, args.model)
-total_chunks = len(chunks)
+    Returns:
+        The model's output token limit, or DEFAULT_MAX_OUTPUT_TOKENS for
+        models not in MAX_OUTPUT_TOKENS.
+    """
+    for prefix, max_tokens in MAX_OUTPUT_TOKENS.items():
+        if model.startswith(prefix):
+            return max_tokens
+    return DEFAULT_MAX_OUTPUT_TOKENS
 
-print(f"Document chunked into {total_chunks} chunks of approximately {args.tokens_per_chunk} tokens each")
-print(f"Chunking took {time.time() - start_time:.2f} seconds")
 
-# Configure pyramid parameters
-print(f"Using window size {args.window_size}, stride {args.stride} for all summary levels")
+def make_request(system_prompt: str, user_prompt: str, model: str, max_tokens: int,
+                 temperature: Optional[float] = None) -> Dict:
+    """Build the messages.create parameters for a single-turn request.
 
-# Initialize system prompt
-system_prompt = prompts.get_system_prompt(
-    context_window_size=args.context_window,
-    tokens_per_selection=args.tokens_per_selection,
-    summary_token_limit=args.summary_token_limit
-)
+    Args:
+        system_prompt: The system prompt for the model.
+        user_prompt: The user message.
+        model: The Claude model to use.
+        max_tokens: Maximum tokens for the response.
+        temperature: Sampling temperature, or None for the API default.
 
-client = anthropic.Anthropic()
+    Returns:
+        Keyword arguments for messages.create.
+    """
+    request = {
+        "model": model,
+        "system": system_prompt,
+        "messages": [{"role": "user", "content": user_prompt}],
+        "max_tokens": max_tokens
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    return request
 
-###########################################################################
-## SUMMARY PYRAMID
-###########################################################################
 
-pyramid_start_time = time.time()
-
-# Initialize with first level: (summary content, start_chunk_index, end_chunk_index)
-current_summaries = [(chunk, idx, idx) for idx, chunk in enumerate(chunks)]
-summary_pyramid = [current_summaries]
-current_level = 1
-
-print(f"Building pyramid level {current_level} with {len(current_summaries)} summaries")
-
-while len(current_summaries) > 1:
-    current_level += 1
-    print(f"Building pyramid level {current_level}")
-    next_summaries = []
-    window_start_idx = 0
-    
-    while window_start_idx < len(current_summaries):
-        window_end_idx = min(window_start_idx + args.window_size, len(current_summaries))
-        
-        summaries_in_window = current_summaries[window_start_idx:window_end_idx]
-        if not summaries_in_window:  # Safeguard against empty windows
+def get_base_summary_request(chunks: List[str], start_chunk: int, end_chunk: int, user_query: str,
+                             system_prompt: str, model: str, summary_token_limit: int,
+                             temperature: Optional[float] = SUMMARY_TEMPERATURE) -> Dict:
+    """Build the messages.create parameters to summarize one window of chunks.
+
+    Args:
+        chunks: All document chunks.
+        start_chunk: Index of the first chunk in the window.
+        end_chunk: Index of the last chunk in the window (inclusive).
+        user_query: The user's query about the document.
+        system_prompt: The system prompt for the model.
+        model: The Claude model to use.
+        summary_token_limit: Maximum tokens for the summary.
+        temperature: Sampling temperature, or None for the API default.
+
+    Returns:
+        Keyword arguments for messages.create.
+    """
+    user_prompt = prompts.get_base_summary_prompt(
+        user_query=user_query,
+        total_chunks=len(chunks),
+        chunk_range_start=start_chunk+1,  # Convert to 1-based indexing
+        chunk_range_end=end_chunk+1,      # Convert to 1-based indexing
+        chunk_content="".join(chunks[start_chunk:end_chunk+1])
+    )
+
+    return make_request(system_prompt, user_prompt, model, summary_token_limit, temperature)
+
+
+def get_recursive_summary_request(summaries_in_window: List[Summary], window_start_idx: int,
+                                  total_summaries: int, user_query: str, total_chunks: int, summary_level: int,
+                                  system_prompt: str, model: str, summary_token_limit: int,
+                                  temperature: Optional[float] = SUMMARY_TEMPERATURE) -> Dict:
+    """Build the messages.create parameters to combine one window of summaries.
+
+    Args:
+        summaries_in_window: The previous level's summaries in this window.
+        window_start_idx: Index of the first summary in the window.
+        total_summaries: Number of summaries at the previous level.
+        user_query: The user's query about the document.
+        total_chunks: The total number of chunks in the document.
+        summary_level: The level of the summaries being combined.
+        system_prompt: The system prompt for the model.
+        model: The Claude model to use.
+        summary_token_limit: Maximum tokens for the summary.
+        temperature: Sampling temperature, or None for the API default.
+
+    Returns:
+        Keyword arguments for messages.create.
+    """
+    new_summary_start_chunk = summaries_in_window[0][1]  # Access start_chunk_index
+    new_summary_end_chunk = summaries_in_window[-1][2]   # Access end_chunk_index
+
+    summary_objects = [
+        {
+            "start_chunk": start+1,  # Convert to 1-based indexing
+            "end_chunk": end+1,      # Convert to 1-based indexing
+            "content": summary_text
+        }
+        for summary_text, start, end in summaries_in_window
+    ]
+
+    user_prompt = prompts.get_recursive_summary_prompt(
+        user_query=user_query,
+        total_chunks=total_chunks,
+        summary_level=summary_level,
+        summary_range_start=window_start_idx+1,
+        summary_range_end=window_start_idx+len(summaries_in_window),
+        total_summaries=total_summaries,
+        chunk_range_start=new_summary_start_chunk+1,  # Convert to 1-based indexing
+        chunk_range_end=new_summary_end_chunk+1,      # Convert to 1-based indexing
+        summaries=summary_objects
+    )
+
+    return make_request(system_prompt, user_prompt, model, summary_token_limit, temperature)
+
+
+async def submit_batch(requests: List[Dict]) -> List[Optional[str]]:
+    """Run requests through the Message Batches API and wait for the results.
+
+    Batched requests are billed at half price but may take a while to
+    finish, so this is meant for large, non-interactive runs.
+
+    Args:
+        requests: Keyword arguments for messages.create, one per request.
+
+    Returns:
+        The response text for each request, in the same order as requests,
+        or None for a request that errored, expired or was canceled.
+    """
+    client = get_client()
+    create_batch = retry_on_transient_errors()(client.messages.batches.create)
+    retrieve_batch = retry_on_transient_errors()(client.messages.batches.retrieve)
+
+    batch = await create_batch(requests=[
+        {"custom_id": f"w{i}", "params": request} for i, request in enumerate(requests)
+    ])
+    print(f"  Submitted batch {batch.id} with {len(requests)} requests")
+
+    # Poll with exponential backoff until every request has finished
+    delay = BATCH_POLL_INITIAL_DELAY
+    while batch.processing_status != "ended":
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+        batch = await retrieve_batch(batch.id)
+
+    # The results are already paid for, so a dropped connection while
+    # downloading them starts the download over rather than losing the level
+    @retry_on_transient_errors()
+    async def fetch_results() -> List[Optional[str]]:
+        # Results can arrive in any order, so put them back by custom_id
+        texts = [None] * len(requests)
+        async for entry in await client.messages.batches.results(batch.id):
+            if entry.result.type != "succeeded":
+                print(f"  Batch request {entry.custom_id} in batch {batch.id} {entry.result.type}")
+                continue
+            texts[int(entry.custom_id[1:])] = entry.result.message.content[0].text
+        return texts
+
+    return await fetch_results()
+
+
+def estimate_request_tokens(request: Dict) -> int:
+    """Estimate the most tokens a request can use, for rate limiting.
+
+    Args:
+        request: Keyword arguments for messages.create.
+
+    Returns:
+        Estimated input tokens plus the output token limit.
+    """
+    input_tokens = estimate_tokens(request["system"])
+    for message in request["messages"]:
+        input_tokens += estimate_tokens(message["content"])
+    return input_tokens + request["max_tokens"]
+
+
+@retry_on_transient_errors()
+async def create_message(request: Dict, rate_limiter: Optional[AsyncRateLimiter] = None) -> str:
+    """Send one messages.create request and return the response text.
+
+    Args:
+        request: Keyword arguments for messages.create.
+        rate_limiter: Paces the request under the RPM/TPM limits, if given.
+
+    Returns:
+        The response text.
+    """
+    if rate_limiter is None:
+        response = await get_client().messages.create(**request)
+        return response.content[0].text
+
+    await rate_limiter.acquire(estimate_request_tokens(request))
+    raw_response = await get_client().messages.with_raw_response.create(**request)
+    rate_limiter.update_from_headers(raw_response.headers)
+    return raw_response.parse().content[0].text
+
+
+@retry_on_transient_errors()
+async def stream_message_to_file(request: Dict, path: str,
+                                 rate_limiter: Optional[AsyncRateLimiter] = None) -> str:
+    """Stream a response into a file as it is generated.
+
+    The file fills in while the model is still writing, rather than only
+    appearing once the whole response has arrived.
+
+    Args:
+        request: Keyword arguments for messages.stream.
+        path: File to write the response text to.
+        rate_limiter: Paces the request under the RPM/TPM limits, if given.
+
+    Returns:
+        The full response text.
+    """
+    if rate_limiter is not None:
+        await rate_limiter.acquire(estimate_request_tokens(request))
+    with open(path, "w", encoding="utf-8") as f:
+        async with get_client().messages.stream(**request) as stream:
+            if rate_limiter is not None:
+                rate_limiter.update_from_headers(stream.response.headers)
+            async for text in stream.text_stream:
+                f.write(text)
+                f.flush()
+            return await stream.get_final_text()
+
+
+def pack_requests(requests: List[Dict]) -> Dict:
+    """Combine several summary requests into one that asks for all of the summaries.
+
+    The requests must share the model, system prompt and temperature, as the
+    windows of one level do.
+
+    Args:
+        requests: Keyword arguments for messages.create, one per window.
+
+    Returns:
+        Keyword arguments for a single messages.create call.
+    """
+    packed_request = dict(requests[0])
+    packed_request["messages"] = [{"role": "user", "content": prompts.get_packed_summary_prompt(
+        [request["messages"][0]["content"] for request in requests]
+    )}]
+    packed_request["max_tokens"] = sum(request["max_tokens"] for request in requests)
+    return packed_request
+
+
+async def create_packed_message(requests: List[Dict],
+                                rate_limiter: Optional[AsyncRateLimiter] = None) -> List[str]:
+    """Get the summaries for several windows from a single request.
+
+    Any summary missing from the reply is requested again on its own.
+
+    Args:
+        requests: Keyword arguments for messages.create, one per window.
+        rate_limiter: Paces the requests under the RPM/TPM limits, if given.
+
+    Returns:
+        The summary text for each request, in the same order as requests.
+    """
+    response_text = await create_message(pack_requests(requests), rate_limiter)
+    found = {int(window_id): text.strip() for window_id, text in _WINDOW_SUMMARY_RE.findall(response_text)}
+    texts = [found.get(window_id) for window_id in range(1, len(requests) + 1)]
+
+    missing = [i for i, text in enumerate(texts) if not text]
+    retried = await asyncio.gather(*(create_message(requests[i], rate_limiter) for i in missing))
+    for i, text in zip(missing, retried):
+        texts[i] = text
+    return texts
+
+
+async def send_requests(requests: List[Dict], max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                        use_batch_api: bool = False,
+                        rate_limiter: Optional[AsyncRateLimiter] = None,
+                        cache: Optional[SummaryCache] = None,
+                        windows_per_request: int = 1,
+                        show_progress: bool = False) -> List[str]:
+    """Send independent summary requests and collect their response text.
+
+    Args:
+        requests: Keyword arguments for messages.create, one per request.
+        max_concurrency: Maximum number of requests in flight at once.
+        use_batch_api: Send the requests as one Message Batch instead, unless
+            there are too few for the batch's queueing delay to pay off.
+        rate_limiter: Paces direct requests under the RPM/TPM limits, if given.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+        windows_per_request: Ask for this many summaries per direct request,
+            to make fewer requests against an RPM limit. Lowered if the
+            packed reply could exceed the model's output limit.
+        show_progress: Show a progress bar instead of waiting silently.
+
+    Returns:
+        The response text for each request, in the same order as requests.
+    """
+    if use_batch_api:
+        windows_per_request = 1  # Batched requests are never packed
+    elif windows_per_request > 1:
+        # Pack fewer windows rather than ask for more output than the model allows
+        max_output_tokens = min(get_max_output_tokens(request["model"]) for request in requests)
+        max_windows = max(1, max_output_tokens // max(request["max_tokens"] for request in requests))
+        if windows_per_request > max_windows:
+            print(f"  Packing {max_windows} windows per request instead of {windows_per_request}, "
+                  f"to stay within {max_output_tokens} output tokens")
+            windows_per_request = max_windows
+
+    # A summary from a packed reply wasn't produced by its window's own
+    # request, so it is cached under a key that includes the packing factor
+    cache_keys = requests if windows_per_request == 1 else [
+        dict(request, windows_per_request=windows_per_request) for request in requests
+    ]
+    texts = [cache.get(key) if cache is not None else None for key in cache_keys]
+    missing = [i for i, text in enumerate(texts) if text is None]
+    if len(missing) < len(requests):
+        print(f"  Found {len(requests) - len(missing)} of {len(requests)} summaries in the cache")
+    if not missing:
+        return texts
+
+    if use_batch_api and len(missing) >= BATCH_MIN_REQUESTS:
+        new_texts = await submit_batch([requests[i] for i in missing])
+        for i, text in zip(missing, new_texts):
+            if text is not None:
+                texts[i] = text
+                if cache is not None:
+                    cache.put(cache_keys[i], text)
+        # Keep the summaries the batch did produce and send the rest directly
+        missing = [i for i in missing if texts[i] is None]
+        if not missing:
+            return texts
+        print(f"  Resending {len(missing)} failed batch requests directly")
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def send(group: List[int]):
+        async with semaphore:
+            if len(group) == 1:
+                group_texts = [await create_message(requests[group[0]], rate_limiter)]
+            else:
+                group_texts = await create_packed_message([requests[i] for i in group], rate_limiter)
+        # Store each summary as it arrives so an interrupted run keeps its progress
+        for i, text in zip(group, group_texts):
+            texts[i] = text
+            if cache is not None:
+                cache.put(cache_keys[i], text)
+
+    coroutines = [send(missing[k:k + windows_per_request])
+                  for k in range(0, len(missing), windows_per_request)]
+    if show_progress:
+        await get_progress_bar().gather(*coroutines, desc="  Summarizing", total=len(coroutines))
+    else:
+        await asyncio.gather(*coroutines)
+    return texts
+
+
+async def get_base_summaries(chunks: List[str], user_query: str, system_prompt: str, window_size: int,
+                             stride: int, model: str, summary_token_limit: int,
+                             max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                             use_batch_api: bool = False,
+                             rate_limiter: Optional[AsyncRateLimiter] = None,
+                             cache: Optional[SummaryCache] = None,
+                             temperature: Optional[float] = SUMMARY_TEMPERATURE,
+                             windows_per_request: int = 1,
+                             show_progress: bool = False) -> List[Summary]:
+    """Summarize sliding windows over the document chunks concurrently.
+
+    The windows are independent of each other, so they are all requested
+    at once (up to max_concurrency in flight) rather than one at a time.
+
+    Args:
+        chunks: All document chunks.
+        user_query: The user's query about the document.
+        system_prompt: The system prompt for the model.
+        window_size: Number of chunks per window.
+        stride: Number of chunks to advance between windows.
+        model: The Claude model to use.
+        summary_token_limit: Maximum tokens per summary.
+        max_concurrency: Maximum number of requests in flight at once.
+        use_batch_api: Send the whole level as one Message Batch.
+        rate_limiter: Paces direct requests under the RPM/TPM limits, if given.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+        temperature: Sampling temperature, or None for the API default.
+        windows_per_request: Number of windows to summarize per direct request.
+        show_progress: Show a progress bar instead of a line per window.
+
+    Returns:
+        The window summaries in document order.
+    """
+    windows = get_windows(len(chunks), window_size, stride)
+    requests = []
+    for window_start_idx, window_end_idx in windows:
+        if not show_progress:
+            print(f"  Processing window for chunks {window_start_idx+1}-{window_end_idx}")
+        requests.append(get_base_summary_request(
+            chunks, window_start_idx, window_end_idx-1, user_query,
+            system_prompt, model, summary_token_limit, temperature
+        ))
+
+    texts = await send_requests(requests, max_concurrency, use_batch_api, rate_limiter, cache,
+                                windows_per_request, show_progress)
+    return [(text, window_start_idx, window_end_idx-1)
+            for text, (window_start_idx, window_end_idx) in zip(texts, windows)]
+
+
+async def get_recursive_summaries(current_summaries: List[Summary], user_query: str, total_chunks: int,
+                                  summary_level: int, system_prompt: str, window_size: int, stride: int,
+                                  model: str, summary_token_limit: int,
+                                  max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                  use_batch_api: bool = False,
+                                  rate_limiter: Optional[AsyncRateLimiter] = None,
+                                  cache: Optional[SummaryCache] = None,
+                                  temperature: Optional[float] = SUMMARY_TEMPERATURE,
+                                  windows_per_request: int = 1,
+                                  show_progress: bool = False) -> List[Summary]:
+    """Summarize sliding windows over one pyramid level concurrently.
+
+    Args:
+        current_summaries: All summaries at the previous level.
+        user_query: The user's query about the document.
+        total_chunks: The total number of chunks in the document.
+        summary_level: The level of the summaries being combined.
+        system_prompt: The system prompt for the model.
+        window_size: Number of summaries per window.
+        stride: Number of summaries to advance between windows.
+        model: The Claude model to use.
+        summary_token_limit: Maximum tokens per summary.
+        max_concurrency: Maximum number of requests in flight at once.
+        use_batch_api: Send the whole level as one Message Batch.
+        rate_limiter: Paces direct requests under the RPM/TPM limits, if given.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+        temperature: Sampling temperature, or None for the API default.
+        windows_per_request: Number of windows to summarize per direct request.
+        show_progress: Show a progress bar instead of a line per window.
+
+    Returns:
+        The next level's summaries in document order.
+    """
+    windows = get_windows(len(current_summaries), window_size, stride)
+    requests = []
+    for window_start_idx, window_end_idx in windows:
+        if not show_progress:
+            print(f"  Processing window for chunks {current_summaries[window_start_idx][1]+1}-"
+                  f"{current_summaries[window_end_idx-1][2]+1}")
+        requests.append(get_recursive_summary_request(
+            current_summaries[window_start_idx:window_end_idx], window_start_idx, len(current_summaries),
+            user_query, total_chunks, summary_level, system_prompt, model, summary_token_limit, temperature
+        ))
+
+    texts = await send_requests(requests, max_concurrency, use_batch_api, rate_limiter, cache,
+                                windows_per_request, show_progress)
+    return [(text, current_summaries[window_start_idx][1], current_summaries[window_end_idx-1][2])
+            for text, (window_start_idx, window_end_idx) in zip(texts, windows)]
+
+
+async def get_summary_pyramid(chunks: List[str], user_query: str, system_prompt: str, window_size: int,
+                              stride: int, model: str, summary_token_limit: int,
+                              max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                              use_batch_api: bool = False,
+                              rate_limiter: Optional[AsyncRateLimiter] = None,
+                              output_dir: Optional[str] = None,
+                              cache: Optional[SummaryCache] = None,
+                              base_model: Optional[str] = None,
+                              temperature: Optional[float] = SUMMARY_TEMPERATURE,
+                              windows_per_request: int = 1,
+                              max_top_level_tokens: Optional[int] = None,
+                              base_window_size: Optional[int] = None,
+                              base_stride: Optional[int] = None,
+                              show_progress: bool = False) -> List[List[Summary]]:
+    """Build the summary pyramid for a document.
+
+    Windows within a level are summarized concurrently, but the levels
+    themselves are built in order since each one summarizes the last.
+    If output_dir is given, each finished level is written to disk in a
+    worker thread while the next level is being summarized.
+
+    Args:
+        chunks: All document chunks.
+        user_query: The user's query about the document.
+        system_prompt: The system prompt for the model.
+        window_size: Window size for the summary levels.
+        stride: Stride for the summary levels.
+        model: The Claude model to use for the levels above the base level.
+        summary_token_limit: Maximum tokens per summary.
+        max_concurrency: Maximum number of requests in flight at once.
+        use_batch_api: Send each level as one Message Batch.
+        rate_limiter: Paces direct requests under the RPM/TPM limits, if given.
+        output_dir: Directory to write each level's summaries to, if given.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+        base_model: The Claude model to use for the base level, if not model.
+        temperature: Sampling temperature for summaries, or None for the API default.
+        windows_per_request: Number of windows to summarize per direct request.
+        max_top_level_tokens: Stop at the first summary level whose summaries
+            total at most this many tokens, instead of combining them down to
+            a single summary.
+        base_window_size: Window size for the base level, if not window_size.
+        base_stride: Stride for the base level, if not stride (capped at
+            the base window size).
+        show_progress: Show a progress bar per level instead of a line per window.
+
+    Returns:
+        Every level of the pyramid, starting with the chunks themselves and
+        ending with a level containing a single summary (or, with
+        max_top_level_tokens, a level that fits within it).
+    """
+    total_chunks = len(chunks)
+    base_model = base_model or model
+    base_window_size, base_stride = get_base_window(window_size, stride, base_window_size, base_stride)
+    loop = asyncio.get_running_loop()
+    pending_writes = []
+
+    def save_level(level: int, summaries: List[Summary]):
+        if output_dir is not None:
+            print(f"  Writing {len(summaries)} summaries for level {level}")
+            pending_writes.append(loop.run_in_executor(None, write_level, output_dir, level, summaries))
+
+    # Initialize with first level: (summary content, start_chunk_index, end_chunk_index)
+    current_summaries = [(chunk, idx, idx) for idx, chunk in enumerate(chunks)]
+    summary_pyramid = [current_summaries]
+    current_level = 1
+
+    print(f"Building pyramid level {current_level} with {len(current_summaries)} summaries")
+    save_level(current_level, current_summaries)
+
+    while len(current_summaries) > 1:
+        # Each extra level costs calls and loses detail, so stop as soon as
+        # the summaries can all go to the final answer as they are
+        if (max_top_level_tokens is not None and len(summary_pyramid) > 1
+                and sum(count_tokens(summary) for summary, _, _ in current_summaries) <= max_top_level_tokens):
+            print(f"  The {len(current_summaries)} summaries at level {current_level} fit in the context window, so stopping here")
             break
-            
-        new_summary_start_chunk = summaries_in_window[0][1]  # Access start_chunk_index
-        new_summary_end_chunk = summaries_in_window[-1][2]   # Access end_chunk_index
-        
-        print(f"  Processing window for chunks {new_summary_start_chunk+1}-{new_summary_end_chunk+1}")
-        
+
+        current_level += 1
+        print(f"Building pyramid level {current_level}")
+
         if len(summary_pyramid) == 1:
-            # For base level, collect the actual text chunks
-            chunk_text = "".join([s[0] for s in summaries_in_window])
-            user_prompt = prompts.get_base_summary_prompt(
-                user_query=query,
-                total_chunks=total_chunks,
-                chunk_range_start=new_summary_start_chunk+1,  # Convert to 1-based indexing
-                chunk_range_end=new_summary_end_chunk+1,      # Convert to 1-based indexing
-                chunk_content=chunk_text
+            # For base level, summarize windows of the actual text chunks
+            next_summaries = await get_base_summaries(
+                chunks, user_query, system_prompt, base_window_size, base_stride,
+                base_model, summary_token_limit, max_concurrency, use_batch_api, rate_limiter, cache,
+                temperature, windows_per_request, show_progress
             )
         else:
             # For higher levels, use the summaries from previous level
-            summary_objects = []
-            for summary_text, start, end in summaries_in_window:
-                summary_objects.append({
-                    "start_chunk": start+1,  # Convert to 1-based indexing
-                    "end_chunk": end+1,      # Convert to 1-based indexing
-                    "content": summary_text
-                })
-
-            user_prompt = prompts.get_recursive_summary_prompt(
-                user_query=query,
-                total_chunks=total_chunks,
-                summary_level=current_level-1,  # Current level of input summaries
-                summary_range_start=window_start_idx+1,
-                summary_range_end=window_end_idx,
-                total_summaries=len(current_summaries),
-                chunk_range_start=new_summary_start_chunk+1,  # Convert to 1-based indexing
-                chunk_range_end=new_summary_end_chunk+1,      # Convert to 1-based indexing
-                summaries=summary_objects
+            next_summaries = await get_recursive_summaries(
+                current_summaries, user_query, total_chunks, current_level-1, system_prompt,
+                window_size, stride, model, summary_token_limit, max_concurrency, use_batch_api,
+                rate_limiter, cache, temperature, windows_per_request, show_progress
             )
 
-        response = client.messages.create(
-            model=args.model,
-            system=system_prompt,
-            messages=[{"role": "user", "content": user_prompt}],
-            max_tokens=args.summary_token_limit
+        print(f"  Created {len(next_summaries)} summaries at level {current_level}")
+        current_summaries = next_summaries
+        summary_pyramid.append(current_summaries)
+        save_level(current_level, current_summaries)
+
+    await asyncio.gather(*pending_writes)
+    return summary_pyramid
+
+
+async def get_summary_pyramid_pipelined(chunks: List[str], user_query: str, system_prompt: str, window_size: int,
+                                        stride: int, model: str, summary_token_limit: int,
+                                        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                        rate_limiter: Optional[AsyncRateLimiter] = None,
+                                        output_dir: Optional[str] = None,
+                                        cache: Optional[SummaryCache] = None,
+                                        base_model: Optional[str] = None,
+                                        temperature: Optional[float] = SUMMARY_TEMPERATURE,
+                                        base_window_size: Optional[int] = None,
+                                        base_stride: Optional[int] = None,
+                                        show_progress: bool = False) -> List[List[Summary]]:
+    """Build the summary pyramid, starting each summary as soon as its inputs are ready.
+
+    Produces the same pyramid as get_summary_pyramid, but a window does not
+    wait for its whole level to finish, only for the summaries it covers.
+    The shape of the pyramid depends only on the number of chunks, so every
+    summary is scheduled up front as a task that waits on the tasks below it.
+
+    Args:
+        chunks: All document chunks.
+        user_query: The user's query about the document.
+        system_prompt: The system prompt for the model.
+        window_size: Window size for the summary levels.
+        stride: Stride for the summary levels.
+        model: The Claude model to use for the levels above the base level.
+        summary_token_limit: Maximum tokens per summary.
+        max_concurrency: Maximum number of requests in flight at once.
+        rate_limiter: Paces requests under the RPM/TPM limits, if given.
+        output_dir: Directory to write each level's summaries to, if given.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+        base_model: The Claude model to use for the base level, if not model.
+        temperature: Sampling temperature for summaries, or None for the API default.
+        base_window_size: Window size for the base level, if not window_size.
+        base_stride: Stride for the base level, if not stride (capped at
+            the base window size).
+        show_progress: Show one progress bar for the whole pyramid.
+
+    Returns:
+        Every level of the pyramid, starting with the chunks themselves and
+        ending with a level containing a single summary.
+    """
+    total_chunks = len(chunks)
+    base_model = base_model or model
+    base_window_size, base_stride = get_base_window(window_size, stride, base_window_size, base_stride)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def summarize(request: Dict, start_chunk: int, end_chunk: int) -> Summary:
+        text = cache.get(request) if cache is not None else None
+        if text is None:
+            async with semaphore:
+                text = await create_message(request, rate_limiter)
+            if cache is not None:
+                cache.put(request, text)
+        return (text, start_chunk, end_chunk)
+
+    async def summarize_window(previous_level: List[asyncio.Future], window_start_idx: int,
+                               window_end_idx: int, summary_level: int) -> Summary:
+        summaries_in_window = list(await asyncio.gather(*previous_level[window_start_idx:window_end_idx]))
+        request = get_recursive_summary_request(
+            summaries_in_window, window_start_idx, len(previous_level), user_query, total_chunks,
+            summary_level, system_prompt, model, summary_token_limit, temperature
         )
-        
-        new_summary_text = response.content[0].text
-        next_summaries.append((new_summary_text, new_summary_start_chunk, new_summary_end_chunk))
-        
-        window_start_idx += args.stride
-    
-    print(f"  Created {len(next_summaries)} summaries at level {current_level}")
-    current_summaries = next_summaries
-    summary_pyramid.append(current_summaries)
-
-pyramid_elapsed_time = time.time() - pyramid_start_time
-print(f"\nPyramid generation completed in {pyramid_elapsed_time:.2f} seconds")
-print(f"Generated {len(summary_pyramid)} levels of summaries")
+        return await summarize(request, summaries_in_window[0][1], summaries_in_window[-1][2])
 
-###########################################################################
-## GET THE FINAL ANSWER
-###########################################################################
+    # Initialize with first level: (summary content, start_chunk_index, end_chunk_index)
+    current_summaries = [(chunk, idx, idx) for idx, chunk in enumerate(chunks)]
+    summary_pyramid = [current_summaries]
+    print(f"Building pyramid level 1 with {len(current_summaries)} summaries")
 
-if not current_summaries:
-    print("Error: No summaries generated. Cannot create final answer.")
-    exit(1)
+    # Schedule every level above the chunks
+    levels = []
+    if total_chunks > 1:
+        levels.append([
+            asyncio.ensure_future(summarize(get_base_summary_request(
+                chunks, window_start_idx, window_end_idx-1, user_query,
+                system_prompt, base_model, summary_token_limit, temperature
+            ), window_start_idx, window_end_idx-1))
+            for window_start_idx, window_end_idx in get_windows(total_chunks, base_window_size, base_stride)
+        ])
+        print(f"Scheduled pyramid level 2 with {len(levels[-1])} windows")
+    while levels and len(levels[-1]) > 1:
+        previous_level = levels[-1]
+        summary_level = len(levels) + 1  # Level of the summaries being combined
+        levels.append([
+            asyncio.ensure_future(summarize_window(previous_level, window_start_idx, window_end_idx, summary_level))
+            for window_start_idx, window_end_idx in get_windows(len(previous_level), window_size, stride)
+        ])
+        print(f"Scheduled pyramid level {summary_level+1} with {len(levels[-1])} windows")
 
-final_summary = current_summaries[0][0]
-answer_start_time = time.time()
+    # One bar for the whole pyramid, since every level is in flight at once
+    progress = None
+    log = print
+    if show_progress and levels:
+        progress = get_progress_bar()(total=sum(len(tasks) for tasks in levels), desc="Summarizing")
+        log = progress.write  # Print above the bar rather than through it
+        for tasks in levels:
+            for task in tasks:
+                task.add_done_callback(lambda _: progress.update())
 
-user_prompt = prompts.get_final_answer_prompt(
-    user_query=query,
-    total_chunks=total_chunks,
-    total_summary_levels=len(summary_pyramid),
-    final_summary=final_summary
-)
+    # Collect the levels in order, writing each one out as soon as it is complete
+    pending_writes = []
+    if output_dir is not None:
+        pending_writes.append(loop.run_in_executor(None, write_level, output_dir, 1, current_summaries))
+    for level, tasks in enumerate(levels, 2):
+        current_summaries = list(await asyncio.gather(*tasks))
+        log(f"  Created {len(current_summaries)} summaries at level {level}")
+        summary_pyramid.append(current_summaries)
+        if output_dir is not None:
+            pending_writes.append(loop.run_in_executor(None, write_level, output_dir, level, current_summaries))
 
-# Call the API
-response = client.messages.create(
-    model=args.model,
-    system=system_prompt,
-    messages=[{"role": "user", "content": user_prompt}],
-    max_tokens=args.answer_token_limit
-)
+    if progress is not None:
+        progress.close()
+
+    await asyncio.gather(*pending_writes)
+    return summary_pyramid
 
-# Extract the answer text from the response
-answer = response.content[0].text
-answer_elapsed_time = time.time() - answer_start_time
 
 ###########################################################################
 ## SAVE OUTPUT
 ###########################################################################
 
-# Write out all summaries to the directory structure
-for level, summaries in enumerate(summary_pyramid, 1):  # Start numbering from 1
+def write_level(output_dir: str, level: int, summaries: List[Summary]):
+    """Write one pyramid level's summaries to output_dir/level_<level>/.
+
+    Args:
+        output_dir: Directory to store outputs.
+        level: The pyramid level, numbered from 1.
+        summaries: The summaries at that level.
+    """
     # Create a directory for this level
-    level_dir = os.path.join(args.output_dir, f"level_{level}")
+    level_dir = os.path.join(output_dir, f"level_{level}")
     os.makedirs(level_dir, exist_ok=True)
-    
-    print(f"\nWriting {len(summaries)} summaries for level {level}")
-    
+
     # Write each summary to a file named by its chunk range
-    for i, (summary, start_chunk, end_chunk) in enumerate(summaries, 1):  # Start numbering from 1
+    for summary, start_chunk, end_chunk in summaries:
         # Create the filename based on the chunk range - convert to 1-based indexing for filenames
         filename = f"chunks_{start_chunk+1}-{end_chunk+1}.txt"
-        filepath = os.path.join(level_dir, filename)
-        
-        # Write the summary to the file
-        with open(filepath, "w", encoding="utf-8") as f:
+        with open(os.path.join(level_dir, filename), "w", encoding="utf-8") as f:
             f.write(summary)
-        
-        print(f"  Wrote summary {i}: chunks {start_chunk+1}-{end_chunk+1}")
 
-# Write the final answer to a file
-answer_path = os.path.join(args.output_dir, "final_answer.txt")
-with open(answer_path, "w", encoding="utf-8") as f:
-    f.write(answer)
 
-# Also write the final summary for reference
-summary_path = os.path.join(args.output_dir, "final_summary.txt")
-with open(summary_path, "w", encoding="utf-8") as f:
-    f.write(final_summary)
+def write_metadata(output_dir: str, args: argparse.Namespace, query: str, total_chunks: int,
+                   summary_pyramid: List[List[Summary]]) -> str:
+    """Write pyramid_metadata.txt describing the run and the pyramid's shape.
+
+    Args:
+        output_dir: Directory to store outputs.
+        args: The parsed command line arguments.
+        query: The user's query about the document.
+        total_chunks: The total number of chunks in the document.
+        summary_pyramid: Every level of the pyramid.
+
+    Returns:
+        The path of the metadata file.
+    """
+    metadata_path = os.path.join(output_dir, "pyramid_metadata.txt")
+    base_window_size, base_stride = get_base_window(args.window_size, args.stride, args.base_window_size, args.base_stride)
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        f.write(f"Document: {args.document}\n")
+        f.write(f"Query: {query}\n")
+        f.write(f"Total document chunks: {total_chunks}\n")
+        f.write(f"Tokens per chunk: {args.tokens_per_chunk}\n")
+        f.write(f"Tokens per selection: {args.tokens_per_selection}\n")
+        f.write(f"Summary token limit: {args.summary_token_limit}\n")
+        f.write(f"Window size: {args.window_size}\n")
+        f.write(f"Stride: {args.stride}\n")
+        f.write(f"Base window size: {base_window_size}\n")
+        f.write(f"Base stride: {base_stride}\n")
+        f.write(f"Total summary levels: {len(summary_pyramid)}\n\n")
+
+        f.write("Pyramid structure:\n")
+        for level, summaries in enumerate(summary_pyramid, start=1):
+            ranges = ", ".join(f"{start+1}-{end+1}" for _, start, end in summaries)
+            f.write(f"Level {level}: {len(summaries)} entries covering chunks {ranges}\n")
+    return metadata_path
+
+
+def write_final_summary(output_dir: str, final_summary: str) -> str:
+    """Write the top-level summary to output_dir/final_summary.txt.
+
+    Args:
+        output_dir: Directory to store outputs.
+        final_summary: The summary at the top of the pyramid.
+
+    Returns:
+        The path of the summary file.
+    """
+    summary_path = os.path.join(output_dir, "final_summary.txt")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write(final_summary)
+    return summary_path
+
+
+###########################################################################
+## GET THE FINAL ANSWER
+###########################################################################
+
+def get_final_summary(summary_pyramid: List[List[Summary]]) -> str:
+    """Return the summary text at the top of the pyramid.
+
+    If the pyramid stopped with several summaries on its top level, they
+    are joined in document order, each labelled with the chunks it covers.
+
+    Args:
+        summary_pyramid: Every level of the pyramid.
+
+    Returns:
+        The text to answer the query from.
+    """
+    top_level = summary_pyramid[-1]
+    if len(top_level) == 1:
+        return top_level[0][0]
+    return "\n\n".join(
+        f"Summary of chunks {start_chunk+1} through {end_chunk+1}:\n<SUMMARY>\n{summary}\n</SUMMARY>"
+        for summary, start_chunk, end_chunk in top_level
+    )
+
+
+async def get_final_answer(user_query: str, total_chunks: int, summary_pyramid: List[List[Summary]],
+                           system_prompt: str, model: str, answer_token_limit: int, answer_path: str,
+                           rate_limiter: Optional[AsyncRateLimiter] = None,
+                           temperature: Optional[float] = None) -> str:
+    """Answer the user's query from the top of the summary pyramid.
+
+    The answer is streamed into answer_path as it is generated.
+
+    Args:
+        user_query: The user's query about the document.
+        total_chunks: The total number of chunks in the document.
+        summary_pyramid: Every level of the pyramid.
+        system_prompt: The system prompt for the model.
+        model: The Claude model to use.
+        answer_token_limit: Maximum tokens for the answer.
+        answer_path: File to write the answer to.
+        rate_limiter: Paces the request under the RPM/TPM limits, if given.
+        temperature: Sampling temperature, or None for the API default.
+
+    Returns:
+        The answer text.
+    """
+    user_prompt = prompts.get_final_answer_prompt(
+        user_query=user_query,
+        total_chunks=total_chunks,
+        total_summary_levels=len(summary_pyramid),
+        final_summary=get_final_summary(summary_pyramid)
+    )
+
+    return await stream_message_to_file(
+        make_request(system_prompt, user_prompt, model, answer_token_limit, temperature),
+        answer_path, rate_limiter
+    )
+
+
+###########################################################################
+## COMMAND LINE
+###########################################################################
+
+def parse_args() -> argparse.Namespace:
+    """Parse command line arguments for the summary pyramid tool."""
+    parser = argparse.ArgumentParser(description="Generate a summary pyramid for a document and answer queries")
+
+    # Input document and query
+    parser.add_argument("--document", default="documents/mobydick.txt", help="Path to the document file")
+    parser.add_argument("--query", default="queries/query.txt", help="Path to query file or direct query string")
+
+    # Model and token parameters
+    parser.add_argument("--model", default="claude-3-7-sonnet-20250219", help="Claude model to use")
+    parser.add_argument("--base-model", default=None, help="Claude model for base-level summaries, e.g. claude-3-5-haiku-latest for the many easy windows (default: --model)")
+    parser.add_argument("--recursive-model", default=None, help="Claude model for the summary levels above the base level (default: --model)")
+    parser.add_argument("--context-window", type=int, default=100000, help="Context window size in tokens")
+    parser.add_argument("--tokens-per-selection", type=int, default=5000, help="Target size for content selections in tokens")
+    parser.add_argument("--tokens-per-chunk", type=int, default=1000, help="Size to chunk the document into")
+    parser.add_argument("--summary-token-limit", type=int, default=2000, help="Maximum token limit for summaries")
+    parser.add_argument("--answer-token-limit", type=int, default=4000, help="Maximum token limit for final answer")
+    parser.add_argument("--temperature", type=float, default=SUMMARY_TEMPERATURE, help="Sampling temperature for summaries")
+    parser.add_argument("--answer-temperature", type=float, default=None, help="Sampling temperature for the final answer (default: API default)")
+
+    # Sliding window parameters
+    parser.add_argument("--window-size", type=int, default=5, help="Window size for all summary levels")
+    parser.add_argument("--stride", type=int, default=4, help="Stride for all summary levels")
+    parser.add_argument("--base-window-size", type=int, default=None, help="Window size for the base level, e.g. 1 to summarize each chunk once (default: --window-size)")
+    parser.add_argument("--base-stride", type=int, default=None, help="Stride for the base level, at most the base window size (default: --stride, capped at the base window size)")
+    parser.add_argument("--stop-when-fits", action="store_true", help="Answer from the first summary level that fits in the context window instead of summarizing it down to one summary")
+    parser.add_argument("--no-overlap", action="store_true", help="Set the stride to the window size, and the base stride to the base window size, so no chunk is summarized twice")
+
+    # Concurrency parameters
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Maximum number of summary requests in flight at once")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute to stay under (default: no limit)")
+    parser.add_argument("--tpm", type=int, default=None, help="Input plus output tokens per minute to stay under (default: no limit)")
+    parser.add_argument("--progress", action="store_true", help="Show a progress bar instead of a line per window (needs tqdm)")
+    parser.add_argument("--pipeline", action="store_true", help="Start each summary as soon as the summaries it covers are ready, instead of level by level")
+    parser.add_argument("--use-batch-api", action="store_true", help="Send each pyramid level as a Message Batch (half price, but slower)")
+    parser.add_argument("--windows-per-request", type=int, default=1, help="Summarize this many windows per request, to make fewer requests under an RPM limit")
+    parser.add_argument("--http2", action="store_true", help="Multiplex concurrent requests over HTTP/2 (needs httpx[http2])")
+    parser.add_argument("--uvloop", action="store_true", help="Run on the uvloop event loop, which has less per-request overhead (needs uvloop)")
+
+    # Output parameters
+    parser.add_argument("--output-dir", default="pyramid_output", help="Directory to store outputs")
+    parser.add_argument("--clear-output", action="store_true", help="Clear output directory if it exists")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to cache summaries in, so re-runs reuse them")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the summary cache")
+
+    return parser.parse_args()
+
+
+async def run(args: argparse.Namespace):
+    """Build the pyramid, answer the query and write all outputs."""
+    # Progress bars only make sense on a terminal; logs get the per-window lines
+    show_progress = args.progress and sys.stderr.isatty()
+    if show_progress:
+        get_progress_bar()  # Fail now, not partway through the pyramid, if tqdm is missing
+    get_client(http2=args.http2)  # Fail now, not at the first request, if h2 is missing
+
+    # Overlapping windows send the shared chunks to the model twice. Without
+    # overlap, context across a window boundary is still combined one level up
+    if args.no_overlap:
+        args.stride = args.window_size
+        args.base_stride = args.base_window_size if args.base_window_size is not None else args.window_size
+    base_window_size, base_stride = get_base_window(args.window_size, args.stride, args.base_window_size, args.base_stride)
+
+    # Ensure stride is reasonable (to ensure we make progress)
+    assert args.stride > 0, "Stride must be at least 1"
+    assert base_window_size > 0, "Base window size must be at least 1"
+    assert 0 < base_stride <= base_window_size, "Base stride must be between 1 and the base window size, or chunks are skipped"
+    assert not (args.pipeline and args.use_batch_api), "--pipeline sends requests individually, so it can't be combined with --use-batch-api"
+    assert args.windows_per_request > 0, "Windows per request must be at least 1"
+    assert args.windows_per_request == 1 or not (args.pipeline or args.use_batch_api), \
+        "--windows-per-request only applies to level-by-level direct requests, not --pipeline or --use-batch-api"
+    assert not (args.pipeline and args.stop_when_fits), "--pipeline schedules the whole pyramid up front, so it can't be combined with --stop-when-fits"
+
+    # Set up output directory
+    if args.clear_output and os.path.exists(args.output_dir):
+        shutil.rmtree(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Read the document
+    with open(args.document, "r", encoding="utf-8") as f:
+        document = f.read()
+
+    # Read the query - either from file or directly from command line
+    query = read_query(args.query)
+
+    print(f"Document length: {len(document)} characters")
+    print(f"Query: {query}")
+
+    # Chunk the document
+    start_time = time.time()
+    chunks = chunk_document(document, args.tokens_per_chunk, args.model)
+    total_chunks = len(chunks)
+
+    print(f"Document chunked into {total_chunks} chunks of approximately {args.tokens_per_chunk} tokens each")
+    print(f"Chunking took {time.time() - start_time:.2f} seconds")
+
+    # Configure pyramid parameters
+    if (base_window_size, base_stride) == (args.window_size, args.stride):
+        print(f"Using window size {args.window_size}, stride {args.stride} for all summary levels")
+    else:
+        print(f"Using window size {base_window_size}, stride {base_stride} for the base level "
+              f"and window size {args.window_size}, stride {args.stride} above it")
+
+    # Initialize system prompt
+    system_prompt = prompts.get_system_prompt(
+        context_window_size=args.context_window,
+        tokens_per_selection=args.tokens_per_selection,
+        summary_token_limit=args.summary_token_limit
+    )
+
+    max_top_level_tokens = None
+    if args.stop_when_fits:
+        max_top_level_tokens = (args.context_window - args.answer_token_limit
+                                - count_tokens(system_prompt) - ANSWER_PROMPT_MARGIN)
+
+    # Without limits, skip the pacing and the per-response header parsing
+    rate_limiter = AsyncRateLimiter(args.rpm, args.tpm) if args.rpm or args.tpm else None
+    cache = None if args.no_cache else SummaryCache(args.cache_dir)
+
+    pyramid_start_time = time.time()
+    if args.pipeline:
+        summary_pyramid = await get_summary_pyramid_pipelined(
+            chunks, query, system_prompt, args.window_size, args.stride,
+            args.recursive_model or args.model, args.summary_token_limit, args.max_concurrency,
+            rate_limiter, args.output_dir, cache, args.base_model or args.model, args.temperature,
+            args.base_window_size, args.base_stride, show_progress
+        )
+    else:
+        summary_pyramid = await get_summary_pyramid(
+            chunks, query, system_prompt, args.window_size, args.stride,
+            args.recursive_model or args.model, args.summary_token_limit, args.max_concurrency,
+            args.use_batch_api, rate_limiter, args.output_dir, cache, args.base_model or args.model,
+            args.temperature, args.windows_per_request, max_top_level_tokens,
+            args.base_window_size, args.base_stride, show_progress
+        )
+    pyramid_elapsed_time = time.time() - pyramid_start_time
+    print(f"\nPyramid generation completed in {pyramid_elapsed_time:.2f} seconds")
+    print(f"Generated {len(summary_pyramid)} levels of summaries")
+
+    if not summary_pyramid[-1]:
+        print("Error: No summaries generated. Cannot create final answer.")
+        exit(1)
+
+    final_summary = get_final_summary(summary_pyramid)
+    answer_path = os.path.join(args.output_dir, "final_answer.txt")
+    answer_start_time = time.time()
+    answer_task = asyncio.ensure_future(get_final_answer(
+        query, total_chunks, summary_pyramid, system_prompt,
+        args.model, args.answer_token_limit, answer_path, rate_limiter, args.answer_temperature
+    ))
+
+    # The final summary and metadata don't depend on the answer, so write
+    # them while the answer is being generated
+    loop = asyncio.get_running_loop()
+    summary_path, metadata_path = await asyncio.gather(
+        loop.run_in_executor(None, write_final_summary, args.output_dir, final_summary),
+        loop.run_in_executor(None, write_metadata, args.output_dir, args, query, total_chunks, summary_pyramid)
+    )
+    await answer_task
+    answer_elapsed_time = time.time() - answer_start_time
+
+    print(f"\nFinal answer generated in {answer_elapsed_time:.2f} seconds")
+    print(f"Answer written to {answer_path}")
+    print(f"Final summary written to {summary_path}")
+    print(f"Metadata written to {metadata_path}")
+
+    total_elapsed_time = time.time() - start_time
+    print(f"\nTotal processing time: {total_elapsed_time:.2f} seconds")
+
+
+def main():
+    """Main function for command line usage of the summary pyramid system."""
+    args = parse_args()
+    if args.uvloop:
+        get_uvloop().run(run(args))
+    else:
+        asyncio.run(run(args))
 
-print(f"\nFinal answer generated in {answer_elapsed_time:.2f} seconds")
-print(f"Answer written to {answer_path}")
-print(f"Final summary written to {summary_path}")
 
-total_elapsed_time = time.time() - start_time
-print(f"\nTotal processing time: {total_elapsed_time:.2f} seconds")
+if __name__ == "__main__":
+    main()
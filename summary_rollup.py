@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-Summary Rollup: A tool for answering questions about very long documents 
+Summary Rollup: A tool for answering questions about very long documents
 using a recurrent summarization approach.
 """
 
@@ -8,217 +8,355 @@ import os
 import time
 import shutil
 import argparse
-from typing import List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional
 import anthropic
 import recurrent_prompts
 from chunk_document import chunk_document
+from config import read_query
+from summary_cache import DEFAULT_CACHE_DIR, SummaryCache
+
+SUMMARY_TEMPERATURE = 0.0  # Same default as the pyramid, so the two approaches compare like for like
 
 ###########################################################################
-## SETUP
+## SUMMARY ROLLUP
 ###########################################################################
 
-parser = argparse.ArgumentParser(description="Generate a sequential summary rollup for a document and answer queries")
+def make_request(system_prompt: str, user_prompt: str, model: str, max_tokens: int,
+                 temperature: Optional[float] = None) -> Dict:
+    """Build the messages.create parameters for a single-turn request.
+
+    Args:
+        system_prompt: The system prompt for the model.
+        user_prompt: The user message.
+        model: The Claude model to use.
+        max_tokens: Maximum tokens for the response.
+        temperature: Sampling temperature, or None for the API default.
+
+    Returns:
+        Keyword arguments for messages.create.
+    """
+    request = {
+        "model": model,
+        "system": system_prompt,
+        "messages": [{"role": "user", "content": user_prompt}],
+        "max_tokens": max_tokens
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    return request
+
+
+def create_summary(client: anthropic.Anthropic, request: Dict, cache: Optional[SummaryCache] = None) -> str:
+    """Send one summary request, reusing the cached response if there is one.
+
+    Each stage is stored as soon as it arrives, so a re-run after an
+    interruption replays the finished stages from disk.
+
+    Args:
+        client: The Anthropic client.
+        request: Keyword arguments for messages.create.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+
+    Returns:
+        The summary text.
+    """
+    text = cache.get(request) if cache is not None else None
+    if text is None:
+        response = client.messages.create(**request)
+        text = response.content[0].text
+        if cache is not None:
+            cache.put(request, text)
+    return text
+
+
+def write_text(path: str, text: str):
+    """Write text to a file, replacing any existing contents."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def get_summary_rollup(client: anthropic.Anthropic, chunks: List[str], user_query: str, system_prompt: str,
+                       model: str, summary_token_limit: int, output_dir: Optional[str] = None,
+                       cache: Optional[SummaryCache] = None,
+                       temperature: Optional[float] = SUMMARY_TEMPERATURE) -> List[str]:
+    """Summarize a document chunk by chunk, updating a running summary.
+
+    If output_dir is given, each stage is written to output_dir/summaries/
+    in a worker thread while the next stage is generated.
+
+    Args:
+        client: The Anthropic client.
+        chunks: All document chunks.
+        user_query: The user's query about the document.
+        system_prompt: The system prompt for the model.
+        model: The Claude model to use.
+        summary_token_limit: Maximum tokens per summary.
+        output_dir: Directory to write each stage's summary to, if given.
+        cache: Answers repeated requests from disk and stores new ones, if given.
+        temperature: Sampling temperature, or None for the API default.
+
+    Returns:
+        The summary after each stage; the last one covers the whole document.
+    """
+    total_chunks = len(chunks)
+    summaries_dir = os.path.join(output_dir, "summaries") if output_dir is not None else None
+    if summaries_dir is not None:
+        os.makedirs(summaries_dir, exist_ok=True)
+
+    # Process chunks sequentially
+    summary_history = []  # Track all intermediate summaries
+    pending_writes = []
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        def save_stage(stage: int, summary: str):
+            summary_history.append(summary)
+            if summaries_dir is not None:
+                filepath = os.path.join(summaries_dir, f"summary_stage_{stage}_of_{total_chunks}.txt")
+                pending_writes.append(writer.submit(write_text, filepath, summary))
+
+        # Step 1: Process the first chunk to get initial summary
+        print(f"Processing chunk 1 of {total_chunks}")
+        initial_prompt = recurrent_prompts.get_base_summary_prompt(
+            user_query=user_query,
+            total_chunks=total_chunks,
+            chunk_content=chunks[0],
+            summary_token_limit=summary_token_limit
+        )
+
+        current_summary = create_summary(client, make_request(
+            system_prompt, initial_prompt, model, summary_token_limit, temperature
+        ), cache)
+        save_stage(1, current_summary)
+
+        print(f"Generated initial summary")
+
+        # Step 2: Process each subsequent chunk, updating the summary
+        current_chunk = 2  # Start with the second chunk
+        while current_chunk <= total_chunks:
+            print(f"Processing chunk {current_chunk} of {total_chunks}")
+
+            recursive_prompt = recurrent_prompts.get_recursive_summary_prompt(
+                user_query=user_query,
+                total_chunks=total_chunks,
+                current_chunk=current_chunk,
+                chunks_processed=current_chunk,
+                current_summary=current_summary,
+                new_chunk_content=chunks[current_chunk-1],  # 0-indexed array
+                summary_token_limit=summary_token_limit
+            )
+
+            current_summary = create_summary(client, make_request(
+                system_prompt, recursive_prompt, model, summary_token_limit, temperature
+            ), cache)
+            save_stage(current_chunk, current_summary)
+
+            current_chunk += 1
+
+    # Leaving the with block waited for the writes; result() re-raises any write error
+    for future in pending_writes:
+        future.result()
+    if summaries_dir is not None:
+        print(f"Wrote {len(pending_writes)} summary stages to {summaries_dir}")
+
+    return summary_history
 
-# Input document and query
-parser.add_argument("--document", default="documents/mobydick.txt", help="Path to the document file")
-parser.add_argument("--query", default="queries/query.txt", help="Path to query file or direct query string")
 
-# Model and token parameters
-parser.add_argument("--model", default="claude-3-7-sonnet-20250219", help="Claude model to use")
-parser.add_argument("--context-window", type=int, default=100000, help="Context window size in tokens")
-parser.add_argument("--tokens-per-selection", type=int, default=5000, help="Target size for content selections in tokens")
-parser.add_argument("--tokens-per-chunk", type=int, default=1000, help="Size to chunk the document into")
-parser.add_argument("--summary-token-limit", type=int, default=2000, help="Maximum token limit for summaries")
-parser.add_argument("--answer-token-limit", type=int, default=4000, help="Maximum token limit for final answer")
+###########################################################################
+## GET THE FINAL ANSWER
+###########################################################################
 
-# Output parameters
-parser.add_argument("--output-dir", default="rollup_output", help="Directory to store outputs")
-parser.add_argument("--clear-output", action="store_true", help="Clear output directory if it exists")
+def get_final_answer(client: anthropic.Anthropic, user_query: str, total_chunks: int, final_summary: str,
+                     system_prompt: str, model: str, answer_token_limit: int, answer_path: str,
+                     temperature: Optional[float] = None) -> str:
+    """Answer the user's query from the summary of the whole document.
+
+    The answer is streamed into answer_path as it is generated.
+
+    Args:
+        client: The Anthropic client.
+        user_query: The user's query about the document.
+        total_chunks: The total number of chunks in the document.
+        final_summary: The summary after the last stage of the rollup.
+        system_prompt: The system prompt for the model.
+        model: The Claude model to use.
+        answer_token_limit: Maximum tokens for the answer.
+        answer_path: File to write the answer to.
+        temperature: Sampling temperature, or None for the API default.
+
+    Returns:
+        The answer text.
+    """
+    # Use the same system prompt, but create a final answer prompt
+    answer_prompt = f"""<USER_QUERY>
+{user_query}
+</USER_QUERY>
 
-args = parser.parse_args()
+<DOCUMENT_INFO total_chunks="{total_chunks}" />
 
-# Set up output directory
-if args.clear_output and os.path.exists(args.output_dir):
-    shutil.rmtree(args.output_dir)
-os.makedirs(args.output_dir, exist_ok=True)
+Below is a comprehensive summary of the entire document:
 
-# Read the document
-with open(args.document, "r", encoding="utf-8") as f:
-    document = f.read()
+<FINAL_SUMMARY>
+{final_summary}
+</FINAL_SUMMARY>
 
-# Read the query - either from file or directly from command line
-if os.path.exists(args.query):
-    with open(args.query, "r", encoding="utf-8") as f:
-        query = f.read().strip()
-else:
-    query = args.query.strip()
+Based on the summary above, please provide a detailed answer to the user's query. 
+Focus on being accurate, comprehensive, and directly addressing the question asked.
+"""
 
-print(f"Document length: {len(document)} characters")
-print(f"Query: {query}")
+    with open(answer_path, "w", encoding="utf-8") as f:
+        with client.messages.stream(
+            **make_request(system_prompt, answer_prompt, model, answer_token_limit, temperature)
+        ) as stream:
+            for text in stream.text_stream:
+                f.write(text)
+                f.flush()
+            return stream.get_final_text()
 
-# Chunk the document
-start_time = time.time()
-chunks = chunk_document(document, args.tokens_per_chunk, args.model)
-total_chunks = len(chunks)
 
-print(f"Document chunked into {total_chunks} chunks of approximately {args.tokens_per_chunk} tokens each")
-print(f"Chunking took {time.time() - start_time:.2f} seconds")
+###########################################################################
+## SAVE OUTPUT
+###########################################################################
 
-# Initialize system prompt and client
-system_prompt = recurrent_prompts.get_system_prompt(
-    context_window_size=args.context_window,
-    tokens_per_selection=args.tokens_per_selection,
-    summary_token_limit=args.summary_token_limit
-)
+def write_metadata(output_dir: str, args: argparse.Namespace, query: str, total_chunks: int,
+                   summary_history: List[str]) -> str:
+    """Write rollup_metadata.txt describing the run.
+
+    Args:
+        output_dir: Directory to store outputs.
+        args: The parsed command line arguments.
+        query: The user's query about the document.
+        total_chunks: The total number of chunks in the document.
+        summary_history: The summary after each stage.
+
+    Returns:
+        The path of the metadata file.
+    """
+    metadata_path = os.path.join(output_dir, "rollup_metadata.txt")
+    with open(metadata_path, "w", encoding="utf-8") as f:
+        f.write(f"Document: {args.document}\n")
+        f.write(f"Query: {query}\n")
+        f.write(f"Total document chunks: {total_chunks}\n")
+        f.write(f"Tokens per chunk: {args.tokens_per_chunk}\n")
+        f.write(f"Tokens per selection: {args.tokens_per_selection}\n")
+        f.write(f"Summary token limit: {args.summary_token_limit}\n")
+        f.write(f"Total summary stages: {len(summary_history)}\n\n")
+
+        f.write("Processing timeline:\n")
+        for i in range(total_chunks):
+            if i == 0:
+                f.write(f"Stage 1: Initial summary of chunk 1\n")
+            else:
+                f.write(f"Stage {i+1}: Updated summary incorporating chunk {i+1}\n")
+    return metadata_path
 
-client = anthropic.Anthropic()
 
 ###########################################################################
-## SUMMARY ROLLUP
+## COMMAND LINE
 ###########################################################################
 
-rollup_start_time = time.time()
-print(f"\nStarting sequential summary rollup process")
-
-# Process chunks sequentially
-summary_history = []  # Track all intermediate summaries
-
-# Step 1: Process the first chunk to get initial summary
-print(f"Processing chunk 1 of {total_chunks}")
-initial_prompt = recurrent_prompts.get_base_summary_prompt(
-    user_query=query,
-    total_chunks=total_chunks,
-    chunk_content=chunks[0],
-    summary_token_limit=args.summary_token_limit
-)
-
-response = client.messages.create(
-    model=args.model,
-    system=system_prompt,
-    messages=[{"role": "user", "content": initial_prompt}],
-    max_tokens=args.summary_token_limit
-)
-
-current_summary = response.content[0].text
-summary_history.append(current_summary)
-
-print(f"Generated initial summary")
-
-# Step 2: Process each subsequent chunk, updating the summary
-current_chunk = 2  # Start with the second chunk
-while current_chunk <= total_chunks:
-    print(f"Processing chunk {current_chunk} of {total_chunks}")
-    
-    recursive_prompt = recurrent_prompts.get_recursive_summary_prompt(
-        user_query=query,
-        total_chunks=total_chunks,
-        current_chunk=current_chunk,
-        chunks_processed=current_chunk,
-        current_summary=current_summary,
-        new_chunk_content=chunks[current_chunk-1],  # 0-indexed array
-        summary_token_limit=args.summary_token_limit
-    )
-    
-    response = client.messages.create(
-        model=args.model,
-        system=system_prompt,
-        messages=[{"role": "user", "content": recursive_prompt}],
-        max_tokens=args.summary_token_limit
-    )
-    
-    current_summary = response.content[0].text
-    summary_history.append(current_summary)
-    
-    current_chunk += 1
+def parse_args() -> argparse.Namespace:
+    """Parse command line arguments for the summary rollup tool."""
+    parser = argparse.ArgumentParser(description="Generate a sequential summary rollup for a document and answer queries")
 
-rollup_elapsed_time = time.time() - rollup_start_time
-print(f"\nSummary rollup completed in {rollup_elapsed_time:.2f} seconds")
-print(f"Processed {total_chunks} chunks sequentially")
+    # Input document and query
+    parser.add_argument("--document", default="documents/mobydick.txt", help="Path to the document file")
+    parser.add_argument("--query", default="queries/query.txt", help="Path to query file or direct query string")
 
-###########################################################################
-## GET THE FINAL ANSWER
-###########################################################################
+    # Model and token parameters
+    parser.add_argument("--model", default="claude-3-7-sonnet-20250219", help="Claude model to use")
+    parser.add_argument("--context-window", type=int, default=100000, help="Context window size in tokens")
+    parser.add_argument("--tokens-per-selection", type=int, default=5000, help="Target size for content selections in tokens")
+    parser.add_argument("--tokens-per-chunk", type=int, default=1000, help="Size to chunk the document into")
+    parser.add_argument("--summary-token-limit", type=int, default=2000, help="Maximum token limit for summaries")
+    parser.add_argument("--answer-token-limit", type=int, default=4000, help="Maximum token limit for final answer")
+    parser.add_argument("--temperature", type=float, default=SUMMARY_TEMPERATURE, help="Sampling temperature for summaries")
+    parser.add_argument("--answer-temperature", type=float, default=None, help="Sampling temperature for the final answer (default: API default)")
 
-answer_start_time = time.time()
-print("\nGenerating final answer based on complete summary")
+    # Output parameters
+    parser.add_argument("--output-dir", default="rollup_output", help="Directory to store outputs")
+    parser.add_argument("--clear-output", action="store_true", help="Clear output directory if it exists")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory to cache summaries in, so re-runs reuse them")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the summary cache")
 
-# Use the same system prompt, but create a final answer prompt
-answer_prompt = f"""<USER_QUERY>
-{query}
-</USER_QUERY>
+    return parser.parse_args()
 
-<DOCUMENT_INFO total_chunks="{total_chunks}" />
 
-Below is a comprehensive summary of the entire document:
+def main():
+    """Main function for command line usage of the summary rollup system."""
+    args = parse_args()
 
-<FINAL_SUMMARY>
-{current_summary}
-</FINAL_SUMMARY>
+    # Set up output directory
+    if args.clear_output and os.path.exists(args.output_dir):
+        shutil.rmtree(args.output_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
 
-Based on the summary above, please provide a detailed answer to the user's query. 
-Focus on being accurate, comprehensive, and directly addressing the question asked.
-"""
+    # Read the document
+    with open(args.document, "r", encoding="utf-8") as f:
+        document = f.read()
 
-response = client.messages.create(
-    model=args.model,
-    system=system_prompt,
-    messages=[{"role": "user", "content": answer_prompt}],
-    max_tokens=args.answer_token_limit
-)
+    # Read the query - either from file or directly from command line
+    query = read_query(args.query)
 
-answer = response.content[0].text
-answer_elapsed_time = time.time() - answer_start_time
+    print(f"Document length: {len(document)} characters")
+    print(f"Query: {query}")
 
-###########################################################################
-## SAVE OUTPUT
-###########################################################################
+    # Chunk the document
+    start_time = time.time()
+    chunks = chunk_document(document, args.tokens_per_chunk, args.model)
+    total_chunks = len(chunks)
+
+    print(f"Document chunked into {total_chunks} chunks of approximately {args.tokens_per_chunk} tokens each")
+    print(f"Chunking took {time.time() - start_time:.2f} seconds")
 
-# Create directory for summary stages
-summaries_dir = os.path.join(args.output_dir, "summaries")
-os.makedirs(summaries_dir, exist_ok=True)
-
-# Write all intermediate summaries
-for i, summary in enumerate(summary_history, 1):
-    filename = f"summary_stage_{i}_of_{len(summary_history)}.txt"
-    filepath = os.path.join(summaries_dir, filename)
-    
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(summary)
-    
-    print(f"Wrote summary stage {i} to {filepath}")
-
-# Write the final answer
-answer_path = os.path.join(args.output_dir, "final_answer.txt")
-with open(answer_path, "w", encoding="utf-8") as f:
-    f.write(answer)
-
-# Write the final summary for reference
-summary_path = os.path.join(args.output_dir, "final_summary.txt")
-with open(summary_path, "w", encoding="utf-8") as f:
-    f.write(current_summary)
-
-# Create metadata file
-metadata_path = os.path.join(args.output_dir, "rollup_metadata.txt")
-with open(metadata_path, "w", encoding="utf-8") as f:
-    f.write(f"Document: {args.document}\n")
-    f.write(f"Query: {query}\n")
-    f.write(f"Total document chunks: {total_chunks}\n")
-    f.write(f"Tokens per chunk: {args.tokens_per_chunk}\n")
-    f.write(f"Tokens per selection: {args.tokens_per_selection}\n")
-    f.write(f"Summary token limit: {args.summary_token_limit}\n")
-    f.write(f"Total summary stages: {len(summary_history)}\n\n")
-    
-    f.write("Processing timeline:\n")
-    for i in range(total_chunks):
-        if i == 0:
-            f.write(f"Stage 1: Initial summary of chunk 1\n")
-        else:
-            f.write(f"Stage {i+1}: Updated summary incorporating chunk {i+1}\n")
-
-print(f"\nFinal answer generated in {answer_elapsed_time:.2f} seconds")
-print(f"Answer written to {answer_path}")
-print(f"Final summary written to {summary_path}")
-print(f"Metadata written to {metadata_path}")
-
-total_elapsed_time = time.time() - start_time
-print(f"\nTotal processing time: {total_elapsed_time:.2f} seconds")
\ No newline at end of file
+    # Initialize system prompt and client
+    system_prompt = recurrent_prompts.get_system_prompt(
+        context_window_size=args.context_window,
+        tokens_per_selection=args.tokens_per_selection,
+        summary_token_limit=args.summary_token_limit
+    )
+
+    client = anthropic.Anthropic()
+    cache = None if args.no_cache else SummaryCache(args.cache_dir)
+
+    rollup_start_time = time.time()
+    print(f"\nStarting sequential summary rollup process")
+    summary_history = get_summary_rollup(
+        client, chunks, query, system_prompt, args.model, args.summary_token_limit, args.output_dir, cache,
+        args.temperature
+    )
+    final_summary = summary_history[-1]
+
+    rollup_elapsed_time = time.time() - rollup_start_time
+    print(f"\nSummary rollup completed in {rollup_elapsed_time:.2f} seconds")
+    print(f"Processed {total_chunks} chunks sequentially")
+
+    answer_path = os.path.join(args.output_dir, "final_answer.txt")
+    summary_path = os.path.join(args.output_dir, "final_summary.txt")
+    answer_start_time = time.time()
+    print("\nGenerating final answer based on complete summary")
+
+    # The final summary and metadata don't depend on the answer, so write
+    # them in a worker thread while the answer is being generated
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        summary_write = writer.submit(write_text, summary_path, final_summary)
+        metadata_write = writer.submit(write_metadata, args.output_dir, args, query, total_chunks, summary_history)
+        get_final_answer(
+            client, query, total_chunks, final_summary, system_prompt, args.model, args.answer_token_limit,
+            answer_path, args.answer_temperature
+        )
+    answer_elapsed_time = time.time() - answer_start_time
+    summary_write.result()
+    metadata_path = metadata_write.result()
+
+    print(f"\nFinal answer generated in {answer_elapsed_time:.2f} seconds")
+    print(f"Answer written to {answer_path}")
+    print(f"Final summary written to {summary_path}")
+    print(f"Metadata written to {metadata_path}")
+
+    total_elapsed_time = time.time() - start_time
+    print(f"\nTotal processing time: {total_elapsed_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()